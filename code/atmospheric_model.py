@@ -1,6 +1,19 @@
+import os
 import math
+import tempfile
+import collections
+import numpy
 GRAVITY = 9.81  # Acceleration due to gravity at Earth's surface [m/s^2]
 EARTH_RADIUS = 6.371 * 10 ** 6  # Radius of Earth in meters
+GAS_CONSTANT = 286.9  # Specific gas constant of air [J/(kg*K)] (0.2869 kJ/(kg*K) as used by density)
+HEAT_CAPACITY_RATIO = 1.4  # Ratio of specific heats of air [ ]
+
+# Bump this whenever the layer model or the table layout changes so stale cached grids are resampled
+TABLE_VERSION = 1
+
+# Everything the physics needs to know about the atmosphere at one altitude (or one array of altitudes)
+AtmosphereState = collections.namedtuple('AtmosphereState',
+                                         ['temperature', 'pressure', 'density', 'gravity', 'speed_of_sound'])
 
 
 def temperature(altitude):
@@ -47,3 +60,387 @@ def gravity(altitude):
     :return: Acceleration due to gravity in m/s^2.
     """
     return GRAVITY / (1 + altitude / EARTH_RADIUS) ** 2
+
+
+def density_gradient(altitude):
+    """
+    This function calculates the derivative of the density of Earth's atmosphere with respect to altitude.
+    :param altitude: Altitude of the desired derivative in meters
+    :return: Derivative of density in kg/m^4.
+    """
+    if altitude > 25000:
+        kelvin = -131.21 + 0.00299 * altitude + 273.1
+        return density(altitude) * (-11.388 - 1) * 0.00299 / kelvin
+    elif altitude > 11000:
+        return density(altitude) * -0.000157
+    else:
+        kelvin = 15.04 - 0.00649 * altitude + 273.1
+        return density(altitude) * (5.256 - 1) * -0.00649 / kelvin
+
+
+def _layers(altitude):
+    """
+    This function splits an array of altitudes into the three layers used by the scalar model.
+    :param altitude: Array of altitudes in meters
+    :return: Boolean masks for the upper stratosphere, lower stratosphere and troposphere.
+    """
+    upper = altitude > 25000
+    troposphere = altitude <= 11000
+    lower = ~(upper | troposphere)
+    return upper, lower, troposphere
+
+
+def _layer_index(altitude):
+    """
+    This function numbers the layer each altitude falls in, 0 for the troposphere up to 2 for the upper stratosphere.
+    :param altitude: Array of altitudes in meters
+    :return: Array of layer numbers.
+    """
+    return (altitude > 11000).astype(int) + (altitude > 25000)
+
+
+def temperature_array(altitude):
+    """
+    This function calculates the temperature of Earth's atmosphere for an array of altitudes.
+    :param altitude: Array of altitudes in meters
+    :return: Array of temperatures of Earth's atmosphere in degrees Celsius.
+    """
+    altitude = numpy.asarray(altitude, dtype=float)
+    upper, lower, troposphere = _layers(altitude)
+    return numpy.select([upper, lower, troposphere],
+                        [-131.21 + 0.00299 * altitude, -56.46, 15.04 - 0.00649 * altitude])
+
+
+def pressure_array(altitude):
+    """
+    This function calculates the pressure of Earth's atmosphere for an array of altitudes.
+    Each layer is only evaluated on the altitudes that fall inside it so the troposphere power law is never applied
+    to the negative absolute temperatures it would produce high above its valid range.
+    :param altitude: Array of altitudes in meters
+    :return: Array of pressures of Earth's atmosphere in kPa.
+    """
+    altitude = numpy.asarray(altitude, dtype=float)
+    upper, lower, troposphere = _layers(altitude)
+    result = numpy.empty_like(altitude)
+    result[upper] = 2.488 * ((-131.21 + 0.00299 * altitude[upper] + 273.1) / 216.6) ** -11.388
+    result[lower] = 22.65 * numpy.exp(1.73 - 0.000157 * altitude[lower])
+    result[troposphere] = 101.29 * ((15.04 - 0.00649 * altitude[troposphere] + 273.1) / 288.08) ** 5.256
+    return result
+
+
+def density_array(altitude):
+    """
+    This function calculates the density of Earth's atmosphere for an array of altitudes.
+    :param altitude: Array of altitudes in meters
+    :return: Array of densities of Earth's atmosphere in kg/m^3.
+    """
+    return pressure_array(altitude) / (0.2869 * (temperature_array(altitude) + 273.1))
+
+
+def gravity_array(altitude):
+    """
+    This function calculates the acceleration due to gravity for an array of altitudes.
+    :param altitude: Array of altitudes in meters
+    :return: Array of accelerations due to gravity in m/s^2.
+    """
+    return GRAVITY / (1 + numpy.asarray(altitude, dtype=float) / EARTH_RADIUS) ** 2
+
+
+def state(altitude):
+    """
+    This function calculates the full state of Earth's atmosphere for a given altitude in a single pass.
+    The layer is picked once and the temperature is only evaluated once, unlike calling density, which evaluates
+    temperature twice and pressure once.
+    :param altitude: Altitude of the desired state in meters
+    :return: AtmosphereState with temperature [C], pressure [kPa], density [kg/m^3], gravity [m/s^2] and speed of
+    sound [m/s].
+    """
+    if altitude > 25000:
+        temp = -131.21 + 0.00299 * altitude
+        kelvin = temp + 273.1
+        press = 2.488 * (kelvin / 216.6) ** -11.388
+    elif altitude > 11000:
+        temp = -56.46
+        kelvin = temp + 273.1
+        press = 22.65 * math.exp(1.73 - 0.000157 * altitude)
+    else:
+        temp = 15.04 - 0.00649 * altitude
+        kelvin = temp + 273.1
+        press = 101.29 * (kelvin / 288.08) ** 5.256
+
+    return AtmosphereState(temp,
+                           press,
+                           press / (0.2869 * kelvin),
+                           GRAVITY / (1 + altitude / EARTH_RADIUS) ** 2,
+                           math.sqrt(HEAT_CAPACITY_RATIO * GAS_CONSTANT * kelvin))
+
+
+def state_array(altitude):
+    """
+    This function calculates the full state of Earth's atmosphere for an array of altitudes in a single pass.
+    :param altitude: Array of altitudes in meters
+    :return: AtmosphereState whose fields are arrays matching the shape of altitude, or NumPy scalars for a scalar
+    altitude.
+    """
+    altitude = numpy.asarray(altitude, dtype=float)
+    upper, lower, troposphere = _layers(altitude)
+
+    kelvin = numpy.select([upper, lower, troposphere],
+                          [-131.21 + 0.00299 * altitude, -56.46, 15.04 - 0.00649 * altitude]) + 273.1
+
+    press = numpy.empty_like(altitude)
+    press[upper] = 2.488 * (kelvin[upper] / 216.6) ** -11.388
+    press[lower] = 22.65 * numpy.exp(1.73 - 0.000157 * altitude[lower])
+    press[troposphere] = 101.29 * (kelvin[troposphere] / 288.08) ** 5.256
+
+    # Indexing with () turns the 0-d results of a scalar altitude into scalars and leaves arrays as they are
+    return AtmosphereState((kelvin - 273.1)[()],
+                           press[()],
+                           (press / (0.2869 * kelvin))[()],
+                           (GRAVITY / (1 + altitude / EARTH_RADIUS) ** 2)[()],
+                           numpy.sqrt(HEAT_CAPACITY_RATIO * GAS_CONSTANT * kelvin)[()])
+
+
+class AtmosphereTable:
+    """
+    Tabulated atmosphere backend. The analytic model is sampled once on a uniform altitude grid and queries are
+    answered by linear or cubic (Catmull-Rom) interpolation, so the physics loop does no exp or ** calls per step.
+    The sampled grid is cached as a .npy file that is memory-mapped on later boots. Pass a table to set_backend() to
+    have the physics use it.
+    """
+    LINEAR = 'linear'
+    CUBIC = 'cubic'
+
+    def __init__(self, max_altitude=200000, step=10, method=LINEAR, tolerance=1e-4, cache_directory=None):
+        """
+        :param max_altitude: Highest tabulated altitude in meters, queries above it use the analytic model
+        :param step: Grid spacing in meters, should divide the layer boundaries at 11000 m and 25000 m
+        :param method: AtmosphereTable.LINEAR or AtmosphereTable.CUBIC
+        :param tolerance: Largest allowed relative error against the analytic model, checked at every cell midpoint
+        :param cache_directory: Directory for the .npy cache, None disables the cache
+        """
+        if method not in (self.LINEAR, self.CUBIC):
+            raise ValueError('unknown interpolation method ' + str(method))
+
+        self.max_altitude = float(max_altitude)
+        self.step = float(step)
+        self.inverse_step = 1 / self.step
+        self.method = method
+        self.tolerance = tolerance
+        self.size = int(round(self.max_altitude / self.step)) + 1
+        self.last_cell = self.size - 2  # Index of the highest grid cell
+
+        # One row per AtmosphereState field, one column per grid altitude, so each field is contiguous
+        self.table = self._load(cache_directory)
+
+        # Scalar lookups read plain Python floats, indexing a NumPy array per call costs more than the model itself.
+        # Cell i holds the five fields at its lower edge followed by how much each rises across the cell.
+        slopes = numpy.diff(self.table, axis=1, append=self.table[:, -1:])
+        self.cells = [tuple(cell) for cell in numpy.concatenate([self.table, slopes]).T.tolist()]
+
+        # Cells whose interpolation stencil crosses a layer boundary would blend two layers of a model that is
+        # discontinuous there, so lookups in them use the analytic model instead
+        spread = 1 if self.method == self.LINEAR else 2
+        index = numpy.arange(self.size - 1)
+        low = numpy.maximum(index - spread + 1, 0) * self.step
+        high = numpy.minimum(index + spread, self.size - 1) * self.step
+        self.smooth = _layer_index(low) == _layer_index(high)
+        self.smooth_cells = self.smooth.tolist()
+
+        self.max_error = self.check_error()
+        if self.max_error > self.tolerance:
+            raise ValueError('atmosphere table error ' + str(self.max_error) + ' exceeds tolerance ' +
+                             str(self.tolerance) + ', use a smaller step')
+
+    def _sample(self):
+        """
+        Evaluates the analytic model on the grid.
+        :return: Array of shape (5, size)
+        """
+        return numpy.array(state_array(numpy.arange(self.size) * self.step))
+
+    def _load(self, cache_directory):
+        """
+        Memory-maps the cached grid if there is one that matches, otherwise samples the model and writes the cache.
+        :param cache_directory: Directory for the .npy cache, None disables the cache
+        :return: Array of shape (5, size)
+        """
+        if cache_directory is None:
+            return self._sample()
+
+        file_name = os.path.join(cache_directory, 'atmosphere_v{0}_{1:g}_{2:g}.npy'.format(TABLE_VERSION,
+                                                                                           self.max_altitude,
+                                                                                           self.step))
+        if os.path.exists(file_name):
+            table = numpy.load(file_name, mmap_mode='r')
+            if table.shape == (len(AtmosphereState._fields), self.size):
+                return table
+
+        table = self._sample()
+        # Save to a temporary file unique to this process then rename, so parallel workers mapping the cache never
+        # see a half-written grid
+        temp_name = None
+        try:
+            os.makedirs(cache_directory, exist_ok=True)
+            temp_handle, temp_name = tempfile.mkstemp(dir=cache_directory, suffix='.npy')
+            with os.fdopen(temp_handle, 'wb') as cached:
+                numpy.save(cached, table)
+            os.replace(temp_name, file_name)
+        except OSError:
+            # The cache is only an optimization, fall back to the freshly sampled grid
+            if temp_name is not None and os.path.exists(temp_name):
+                os.remove(temp_name)
+            return table
+        return numpy.load(file_name, mmap_mode='r')
+
+    def _interpolate(self, altitude):
+        """
+        Interpolates every field of the table at an array of in-range altitudes.
+        :param altitude: Array of altitudes in meters, 0 <= altitude <= max_altitude
+        :return: Array of shape (5, len(altitude))
+        """
+        position = altitude * self.inverse_step
+        index = numpy.minimum(position.astype(int), self.last_cell)
+        fraction = position - index
+
+        y1 = self.table[:, index]
+        y2 = self.table[:, index + 1]
+        if self.method == self.LINEAR:
+            values = y1 + fraction * (y2 - y1)
+        else:
+            # Catmull-Rom spline, the missing neighbours at the edges of the grid are linearly extrapolated
+            y0 = numpy.where(index == 0, 2 * y1 - y2, self.table[:, numpy.maximum(index - 1, 0)])
+            y3 = numpy.where(index == self.last_cell, 2 * y2 - y1,
+                             self.table[:, numpy.minimum(index + 2, self.size - 1)])
+            values = y1 + 0.5 * fraction * (y2 - y0 + fraction * (2 * y0 - 5 * y1 + 4 * y2 - y3 +
+                                                                  fraction * (3 * (y1 - y2) + y3 - y0)))
+
+        rough = ~self.smooth[index]
+        if rough.any():
+            values[:, rough] = state_array(altitude[rough])
+        return values
+
+    def check_error(self):
+        """
+        Compares the table against the analytic model at 31 evenly spaced points inside every cell. Linear error
+        peaks at the midpoint, which is one of them, while cubic error peaks off-centre. Cells at a layer boundary
+        are answered by the analytic model, so they are checked too but add no error. Scalar and array lookups give
+        the same values, so one check covers both.
+        :return: Largest relative error over all fields
+        """
+        fraction = numpy.linspace(0, 1, 33)[1:-1]
+        altitude = ((numpy.arange(self.size - 1)[:, None] + fraction) * self.step).ravel()
+        exact = numpy.array(state_array(altitude))
+        return float(numpy.max(numpy.abs(self._interpolate(altitude) - exact) / numpy.abs(exact)))
+
+    def state(self, altitude):
+        """
+        Looks up the state of Earth's atmosphere for a given altitude.
+        :param altitude: Altitude of the desired state in meters
+        :return: AtmosphereState, see state()
+        """
+        if not 0 <= altitude <= self.max_altitude:
+            return state(altitude)
+        position = altitude * self.inverse_step
+        index = int(position)
+        if index > self.last_cell:
+            index = self.last_cell
+        if not self.smooth_cells[index]:
+            return state(altitude)
+        fraction = position - index
+        if self.method == self.CUBIC:
+            return self._cubic(index, fraction)
+
+        temp, press, dens, grav, sound, d_temp, d_press, d_dens, d_grav, d_sound = self.cells[index]
+        return AtmosphereState(temp + fraction * d_temp,
+                               press + fraction * d_press,
+                               dens + fraction * d_dens,
+                               grav + fraction * d_grav,
+                               sound + fraction * d_sound)
+
+    def _cubic(self, index, fraction):
+        """
+        Catmull-Rom interpolation of one cell, see _interpolate().
+        :param index: Grid cell
+        :param fraction: Position inside the cell between 0 and 1
+        :return: AtmosphereState
+        """
+        y1 = self.cells[index][:5]
+        y2 = self.cells[index + 1][:5]
+        y0 = [2 * a - b for a, b in zip(y1, y2)] if index == 0 else self.cells[index - 1][:5]
+        y3 = [2 * b - a for a, b in zip(y1, y2)] if index == self.last_cell else self.cells[index + 2][:5]
+        return AtmosphereState(*[p1 + 0.5 * fraction * (p2 - p0 + fraction * (2 * p0 - 5 * p1 + 4 * p2 - p3 +
+                                                                              fraction * (3 * (p1 - p2) + p3 - p0)))
+                                 for p0, p1, p2, p3 in zip(y0, y1, y2, y3)])
+
+    def density_gradient(self, altitude):
+        """
+        Differentiates the interpolated density with respect to altitude, so it matches what state() returns.
+        :param altitude: Altitude of the desired derivative in meters
+        :return: Derivative of density in kg/m^4.
+        """
+        if not 0 <= altitude <= self.max_altitude:
+            return density_gradient(altitude)
+        position = altitude * self.inverse_step
+        index = int(position)
+        if index > self.last_cell:
+            index = self.last_cell
+        if not self.smooth_cells[index]:
+            return density_gradient(altitude)
+        if self.method == self.LINEAR:
+            return self.cells[index][7] * self.inverse_step
+
+        # Derivative of the Catmull-Rom spline in _cubic() for the density field only
+        fraction = position - index
+        p1 = self.cells[index][2]
+        p2 = self.cells[index + 1][2]
+        p0 = 2 * p1 - p2 if index == 0 else self.cells[index - 1][2]
+        p3 = 2 * p2 - p1 if index == self.last_cell else self.cells[index + 2][2]
+        return 0.5 * (p2 - p0 + fraction * (2 * (2 * p0 - 5 * p1 + 4 * p2 - p3) +
+                                            3 * fraction * (3 * (p1 - p2) + p3 - p0))) * self.inverse_step
+
+    def state_array(self, altitude):
+        """
+        Looks up the state of Earth's atmosphere for an array of altitudes.
+        :param altitude: Array of altitudes in meters
+        :return: AtmosphereState whose fields are arrays matching the shape of altitude, or NumPy scalars for a
+        scalar altitude, as from the module's state_array().
+        """
+        altitude = numpy.asarray(altitude, dtype=float)
+        flat = altitude.ravel()
+        inside = (flat >= 0) & (flat <= self.max_altitude)
+
+        if inside.all():
+            values = self._interpolate(flat)
+        else:
+            values = numpy.empty((len(AtmosphereState._fields), flat.size))
+            values[:, inside] = self._interpolate(flat[inside])
+            values[:, ~inside] = state_array(flat[~inside])
+
+        return AtmosphereState(*[field.reshape(altitude.shape)[()] for field in values])
+
+
+# The atmosphere the physics uses. rocket and batch_simulator call lookup(), lookup_array() and
+# lookup_density_gradient() rather than state(), state_array() and density_gradient(), so a table can be swapped in
+# without touching them. See set_backend().
+lookup = state
+lookup_array = state_array
+lookup_density_gradient = density_gradient
+
+
+def set_backend(table=None):
+    """
+    This function picks the atmosphere model used by the physics in this process. Worker processes started with
+    spawn begin with the analytic model and have to call it themselves.
+    :param table: AtmosphereTable to use, None for the analytic model
+    :return: Nothing is returned
+    """
+    global lookup, lookup_array, lookup_density_gradient
+    if table is None:
+        lookup = state
+        lookup_array = state_array
+        lookup_density_gradient = density_gradient
+    else:
+        lookup = table.state
+        lookup_array = table.state_array
+        lookup_density_gradient = table.density_gradient
@@ -0,0 +1,249 @@
+import time
+import numpy
+import atmospheric_model as atmo
+import rocket as rocket_model
+
+# Stage constants copied into one column per vehicle so each vehicle can be perturbed independently. Thrust and ISP
+# come from the EngineTables of the stage each vehicle is on, scaled per vehicle. Tank flows are fixed by the throttle
+# as in rocket.propellant_flow(), so THRUST_SCALE scales the flow along with the thrust and ISP_SCALE scales the flow
+# needed for that thrust the other way.
+STAGE_PARAMETERS = ['AREA', 'DRAG_COEFFICIENT']
+SCALE_PARAMETERS = ['THRUST_SCALE', 'ISP_SCALE']
+TANKS = ['fuel', 'oxidizer', 'srb']
+
+
+class BatchSimulator:
+    """
+    Propagates N independent vehicles at once. The state is stored as a structure of arrays: one row per state
+    variable (see rocket.ALTITUDE etc.) and one column per vehicle, so every step is a handful of NumPy operations
+    regardless of N. The physics is the same as rocket.step(): the liquid engines and the SRBs have their own thrust
+    tables, tank flows are held constant over a step and the tanks are drained after it. On top of that the thrust can
+    be steered off the velocity vector, which a guidance law sets through the steering array.
+    """
+    def __init__(self, count):
+        # -------------------VARIABLES-------------------
+        self.count = count
+        self.state = numpy.zeros((4, count))  # [altitude, velocity, flight path angle in radians, mass]
+        self.throttle = numpy.ones(count)  # Throttle setting as a fraction of maximum thrust [ ]
+        self.steering = numpy.zeros(count)  # Angle of the thrust above the velocity vector [rad]
+        self.tanks = dict((name, numpy.zeros(count)) for name in TANKS)  # Propellant left in the current stage [kg]
+        self.time = 0  # Mission elapsed time [s]
+
+        # -------------------CONSTANTS-------------------
+        self.parameters = dict((name, numpy.zeros(count)) for name in STAGE_PARAMETERS)
+        self.parameters.update((name, numpy.ones(count)) for name in SCALE_PARAMETERS)
+        self.stages = []  # A stage with each set of engine tables loaded so far, the stage_index column points into it
+        self.stage_index = numpy.zeros(count, dtype=int)  # Stage each vehicle is on, selects its engine tables
+        self.active_stages = []  # Distinct entries of stage_index
+        self.liquid_flow = numpy.zeros(count)  # Fuel plus oxidizer flow of the stage at full throttle [kg/s]
+        self.srb_flow = numpy.zeros(count)  # SRB flow of the stage [kg/s]
+        self.mixture = numpy.zeros(count)  # Oxidizer to fuel ratio of the stage [ ]
+
+        # -------------------PERFORMANCE-------------------
+        self.step_count = 0  # Number of integrator steps taken
+        self.step_time = 0  # Wall time spent inside the integrator [s]
+
+    @property
+    def altitude(self):
+        return self.state[rocket_model.ALTITUDE]
+
+    @property
+    def velocity(self):
+        return self.state[rocket_model.VELOCITY]
+
+    @property
+    def flight_path_angle(self):
+        return self.state[rocket_model.FLIGHT_PATH_ANGLE]
+
+    @property
+    def mass(self):
+        return self.state[rocket_model.MASS]
+
+    def load(self, rocket, index=slice(None)):
+        """
+        Copies a rocket's state, current stage constants and tank levels into some of the vehicle columns.
+        :param rocket: An input rocket containing stage classes and fuel sub-classes.
+        :param index: Vehicles to load, all of them by default
+        :return: Nothing is returned
+        """
+        self.state[:, index] = rocket_model.get_state(rocket)[:, None]
+        for name in SCALE_PARAMETERS:
+            self.parameters[name][index] = 1
+        self.set_stage(rocket, 0, index)
+
+    def set_stage(self, rocket, mass_change, index=slice(None)):
+        """
+        Switches vehicles to a rocket's active stage, e.g. after the rocket staged, keeping their flight state and
+        dispersion scales. The stage constants, engine tables and tank levels are copied from the rocket, vehicles
+        outside index stay on their own stage.
+        :param rocket: An input rocket containing stage classes and fuel sub-classes.
+        :param mass_change: Mass in kg added to every vehicle, negative for what staging dropped
+        :param index: Vehicles to switch, all of them by default
+        :return: Nothing is returned
+        """
+        stage = rocket.stage
+        self.state[rocket_model.MASS, index] += mass_change
+        for name in STAGE_PARAMETERS:
+            self.parameters[name][index] = getattr(stage, name)
+        for name in TANKS:
+            tank = getattr(stage, name)
+            self.tanks[name][index] = 0 if tank is None else tank.mass
+        # Stages are told apart by their engine tables, so copies of one rocket that share its tables, e.g. one
+        # staging timeline per vehicle, still group into one stage and need no masking in thrust()
+        for number, loaded in enumerate(self.stages):
+            if loaded.engine is stage.engine and loaded.srb_engine is stage.srb_engine:
+                break
+        else:
+            number = len(self.stages)
+            self.stages.append(stage)
+        self.stage_index[index] = number
+        self.active_stages = numpy.unique(self.stage_index).tolist()
+        self.liquid_flow[index] = stage.fuel.FLOW_RATE_MAX + stage.oxidizer.FLOW_RATE_MAX
+        self.srb_flow[index] = 0 if stage.srb is None else stage.srb.FLOW_RATE_MAX
+        self.mixture[index] = stage.MIXTURE
+
+    def engine_throttles(self):
+        """
+        :return: Returns every vehicle's fraction of full thrust of the liquid engines, zero once either liquid tank
+        is empty, and of the SRBs, one until they are empty, see rocket.set_propellant_flow()
+        """
+        liquid = self.throttle * ((self.tanks['fuel'] > 0) & (self.tanks['oxidizer'] > 0))
+        srb = (self.tanks['srb'] > 0).astype(float)
+        return liquid, srb
+
+    def burning(self):
+        """
+        :return: Returns a boolean array, True for vehicles with an engine producing thrust
+        """
+        liquid, srb = self.engine_throttles()
+        return (liquid > 0) | (srb > 0)
+
+    def derivatives(self, state, liquid_throttle, srb_throttle, mass_flow, steering=None):
+        """
+        Vectorized form of rocket.derivatives().
+        :param state: State array of shape (4, count)
+        :param liquid_throttle: Fraction of full thrust of every vehicle's liquid engines
+        :param srb_throttle: Fraction of full thrust of every vehicle's SRBs
+        :param mass_flow: Propellant mass flow of every vehicle in kg/s
+        :param steering: Cosine and sine of every vehicle's steering angle, None if the thrust is along the velocity
+        :return: Returns d(state)/dt with the same shape as state
+        """
+        altitude, velocity, flight_path_angle, mass = state
+        atmosphere = atmo.lookup_array(altitude)
+        sin_fpa = numpy.sin(flight_path_angle)
+        cos_fpa = numpy.cos(flight_path_angle)
+
+        thrust_force = self.thrust(atmosphere.pressure, liquid_throttle, srb_throttle) * self.parameters['THRUST_SCALE']
+        drag = 0.5 * atmosphere.density * velocity ** 2 * self.parameters['AREA'] * \
+            self.parameters['DRAG_COEFFICIENT']
+        turning = velocity > rocket_model.MINIMUM_TURN_VELOCITY
+        safe_velocity = numpy.where(turning, velocity, 1)
+        if steering is None:
+            axial_thrust, normal_thrust = thrust_force, 0
+        else:
+            axial_thrust, normal_thrust = thrust_force * steering[0], thrust_force * steering[1]
+
+        d_state = numpy.empty_like(state)
+        d_state[rocket_model.ALTITUDE] = velocity * sin_fpa
+        d_state[rocket_model.VELOCITY] = (axial_thrust - drag) / mass - atmosphere.gravity * sin_fpa
+        turn = normal_thrust / mass - (atmosphere.gravity - velocity ** 2 / (rocket_model.EARTH_RADIUS + altitude)) * \
+            cos_fpa
+        d_state[rocket_model.FLIGHT_PATH_ANGLE] = numpy.where(turning, turn / safe_velocity, 0)
+        d_state[rocket_model.MASS] = -mass_flow
+        return d_state
+
+    def thrust(self, pressure, liquid_throttle, srb_throttle):
+        """
+        Vectorized form of rocket.stage_thrust(), each vehicle uses the engine tables of its own stage.
+        :param pressure: Ambient pressure of every vehicle in kPa
+        :param liquid_throttle: Fraction of full thrust of every vehicle's liquid engines
+        :param srb_throttle: Fraction of full thrust of every vehicle's SRBs
+        :return: Returns the unscaled thrust of every vehicle in N
+        """
+        if len(self.active_stages) == 1:
+            # The usual case, the whole batch is on one stage and needs no masking
+            return self.stage_thrust(self.stages[self.active_stages[0]], pressure, liquid_throttle, srb_throttle)
+
+        thrust_force = numpy.zeros(self.count)
+        for number in self.active_stages:
+            on_stage = self.stage_index == number
+            thrust_force[on_stage] = self.stage_thrust(self.stages[number], pressure[on_stage],
+                                                       liquid_throttle[on_stage], srb_throttle[on_stage])
+        return thrust_force
+
+    @staticmethod
+    def stage_thrust(stage, pressure, liquid_throttle, srb_throttle):
+        """
+        :return: Returns the thrust of vehicles on one stage in N, see thrust()
+        """
+        thrust_force = liquid_throttle * stage.engine.lookup_array(pressure)[0]
+        if stage.srb_engine is not None:
+            thrust_force = thrust_force + srb_throttle * stage.srb_engine.lookup_array(pressure)[0]
+        return thrust_force
+
+    def drain(self, liquid_flow, srb_flow, delta_time):
+        """
+        Empties every vehicle's tanks for one step, as rocket.drain_propellant() does for one rocket.
+        :param liquid_flow: Fuel plus oxidizer flow of every vehicle in kg/s
+        :param srb_flow: SRB flow of every vehicle in kg/s
+        :param delta_time: Time step in seconds
+        :return: Returns the propellant mass every vehicle used
+        """
+        fuel_flow = liquid_flow / (self.mixture + 1)
+        used = 0
+        for name, flow in (('fuel', fuel_flow), ('oxidizer', liquid_flow - fuel_flow), ('srb', srb_flow)):
+            tank_used = numpy.minimum(flow * delta_time, self.tanks[name])
+            self.tanks[name] -= tank_used
+            used = used + tank_used
+        return used
+
+    def step(self, delta_time):
+        """
+        Advances every vehicle by one fixed RK4 step. The throttle, steering and tank flows are held constant over the
+        step, as in rocket.step().
+        :param delta_time: Time step in seconds
+        :return: Returns the state array
+        """
+        start = time.perf_counter()
+
+        liquid_throttle, srb_throttle = self.engine_throttles()
+        flow_scale = self.parameters['THRUST_SCALE'] / self.parameters['ISP_SCALE']
+        liquid_flow = liquid_throttle * self.liquid_flow * flow_scale
+        srb_flow = srb_throttle * self.srb_flow * flow_scale
+        mass_flow = liquid_flow + srb_flow
+        steering = (numpy.cos(self.steering), numpy.sin(self.steering)) if self.steering.any() else None
+
+        mass = self.state[rocket_model.MASS].copy()
+        k1 = self.derivatives(self.state, liquid_throttle, srb_throttle, mass_flow, steering)
+        k2 = self.derivatives(self.state + 0.5 * delta_time * k1, liquid_throttle, srb_throttle, mass_flow, steering)
+        k3 = self.derivatives(self.state + 0.5 * delta_time * k2, liquid_throttle, srb_throttle, mass_flow, steering)
+        k4 = self.derivatives(self.state + delta_time * k3, liquid_throttle, srb_throttle, mass_flow, steering)
+        self.state += delta_time / 6.0 * (k1 + 2 * k2 + 2 * k3 + k4)
+        self.state[rocket_model.MASS] = mass - self.drain(liquid_flow, srb_flow, delta_time)
+        self.time += delta_time
+
+        self.step_count += 1
+        self.step_time += time.perf_counter() - start
+        return self.state
+
+    def steps_per_second(self):
+        """
+        :return: Returns the number of vehicle steps per second of wall time
+        """
+        if self.step_time == 0:
+            return 0
+        return self.step_count * self.count / self.step_time
+
+
+def load_batch(count, rocket=None):
+    """
+    This function creates a batch of identical vehicles from load_rocket() parameters.
+    :param count: Number of vehicles
+    :param rocket: Rocket to copy, a fresh load_rocket(hardware=False) by default
+    :return: Returns a BatchSimulator
+    """
+    if rocket is None:
+        rocket = rocket_model.load_rocket(hardware=False)
+    batch = BatchSimulator(count)
+    batch.load(rocket)
+    return batch
@@ -0,0 +1,220 @@
+import math
+import collections
+import atmospheric_model as atmo
+import rocket as rocket_model
+
+MU = atmo.GRAVITY * atmo.EARTH_RADIUS ** 2  # Gravitational parameter matching atmo.gravity() [m^3/s^2]
+ATMOSPHERE_EDGE = 100000  # Below this altitude drag matters and the flight is integrated numerically [m]
+KEPLER_TOLERANCE = 1e-12  # Accuracy of the eccentric anomaly [rad]
+RADIAL_TOLERANCE = 1e-6  # Orbits with an eccentricity closer to 1 than this are treated as radial or parabolic
+
+# Shape of the orbit in the plane of flight and where the vehicle was on it at the epoch. The state vector only
+# carries altitude, velocity and flight path angle, so the orientation of the orbit is not needed.
+OrbitalElements = collections.namedtuple('OrbitalElements', ['semi_major_axis',  # [m], negative if hyperbolic
+                                                             'eccentricity',
+                                                             'mean_anomaly',  # At the epoch [rad]
+                                                             'mean_motion',  # [rad/s]
+                                                             'epoch'])  # Mission time of mean_anomaly [s]
+
+
+def elements(altitude, velocity, flight_path_angle, epoch=0.0):
+    """
+    This function converts a flight state into orbital elements. Nearly vertical flight gives an eccentricity so
+    close to 1 that the conic equations lose all precision, so it is refused like a parabolic orbit.
+    :param altitude: Altitude in meters
+    :param velocity: Velocity in m/s
+    :param flight_path_angle: Flight path angle in radians
+    :param epoch: Mission time of the state in seconds
+    :return: Returns OrbitalElements
+    """
+    radius = atmo.EARTH_RADIUS + altitude
+    angular_momentum = radius * velocity * math.cos(flight_path_angle)
+    if angular_momentum <= 0:
+        raise ValueError('a vertical or retrograde flight has no coast orbit')
+    energy = velocity ** 2 / 2 - MU / radius
+    if energy == 0:
+        raise ValueError('parabolic orbits are not supported')
+    semi_major_axis = -MU / (2 * energy)
+    eccentricity = math.sqrt(max(1 + 2 * energy * angular_momentum ** 2 / MU ** 2, 0.0))
+    if abs(1 - eccentricity) < RADIAL_TOLERANCE:
+        raise ValueError('nearly radial or parabolic orbits are not supported')
+
+    # True anomaly from the radial and transverse velocity, e sin(v) = h vr / mu and e cos(v) = h^2 / (mu r) - 1
+    true_anomaly = math.atan2(angular_momentum * velocity * math.sin(flight_path_angle) / MU,
+                              angular_momentum ** 2 / (MU * radius) - 1)
+    return OrbitalElements(semi_major_axis, eccentricity, mean_anomaly(true_anomaly, eccentricity),
+                           math.sqrt(MU / abs(semi_major_axis) ** 3), epoch)
+
+
+def mean_anomaly(true_anomaly, eccentricity):
+    """
+    :return: Returns the mean anomaly in radians of a true anomaly
+    """
+    if eccentricity < 1:
+        eccentric = 2 * math.atan(math.sqrt((1 - eccentricity) / (1 + eccentricity)) * math.tan(true_anomaly / 2))
+        return eccentric - eccentricity * math.sin(eccentric)
+    hyperbolic = 2 * math.atanh(math.sqrt((eccentricity - 1) / (eccentricity + 1)) * math.tan(true_anomaly / 2))
+    return eccentricity * math.sinh(hyperbolic) - hyperbolic
+
+
+def true_anomaly(mean, eccentricity):
+    """
+    This function solves Kepler's equation with Newton's method.
+    :return: Returns the true anomaly in radians of a mean anomaly
+    """
+    if eccentricity < 1:
+        mean = math.remainder(mean, 2 * math.pi)
+        eccentric = mean if eccentricity < 0.8 else math.copysign(math.pi, mean)
+        for i in range(50):
+            change = (eccentric - eccentricity * math.sin(eccentric) - mean) / (1 - eccentricity * math.cos(eccentric))
+            eccentric -= change
+            if abs(change) < KEPLER_TOLERANCE:
+                break
+        return 2 * math.atan2(math.sqrt(1 + eccentricity) * math.sin(eccentric / 2),
+                              math.sqrt(1 - eccentricity) * math.cos(eccentric / 2))
+
+    hyperbolic = math.asinh(mean / eccentricity)
+    for i in range(50):
+        change = (eccentricity * math.sinh(hyperbolic) - hyperbolic - mean) / \
+            (eccentricity * math.cosh(hyperbolic) - 1)
+        hyperbolic -= change
+        if abs(change) < KEPLER_TOLERANCE:
+            break
+    return 2 * math.atan(math.sqrt((eccentricity + 1) / (eccentricity - 1)) * math.tanh(hyperbolic / 2))
+
+
+def flight_state(orbit, mission_time):
+    """
+    This function propagates orbital elements analytically, the cost does not depend on how far ahead mission_time is.
+    :param orbit: OrbitalElements
+    :param mission_time: Mission time in seconds
+    :return: Returns the altitude in meters, velocity in m/s and flight path angle in radians
+    """
+    e = orbit.eccentricity
+    anomaly = true_anomaly(orbit.mean_anomaly + orbit.mean_motion * (mission_time - orbit.epoch), e)
+    radius = orbit.semi_major_axis * (1 - e ** 2) / (1 + e * math.cos(anomaly))
+    velocity = math.sqrt(MU * (2 / radius - 1 / orbit.semi_major_axis))
+    return radius - atmo.EARTH_RADIUS, velocity, math.atan2(e * math.sin(anomaly), 1 + e * math.cos(anomaly))
+
+
+def time_to_mean_anomaly(orbit, mission_time, target):
+    """
+    :param orbit: OrbitalElements
+    :param mission_time: Mission time in seconds to measure from
+    :param target: Mean anomaly in radians
+    :return: Returns the time in seconds until the vehicle next reaches the target mean anomaly, None if it never will
+    """
+    mean = orbit.mean_anomaly + orbit.mean_motion * (mission_time - orbit.epoch)
+    if orbit.eccentricity < 1:
+        return ((target - mean) % (2 * math.pi)) / orbit.mean_motion
+    if target < mean:
+        return None
+    return (target - mean) / orbit.mean_motion
+
+
+def entry_mean_anomaly(orbit, altitude):
+    """
+    :param orbit: OrbitalElements
+    :param altitude: Altitude in meters
+    :return: Returns the mean anomaly at which the vehicle descends through altitude, None if the orbit stays above it
+    """
+    e = orbit.eccentricity
+    semi_latus_rectum = orbit.semi_major_axis * (1 - e ** 2)
+    radius = atmo.EARTH_RADIUS + altitude
+    if semi_latus_rectum / (1 + e) >= radius or e == 0:
+        return None
+    cos_anomaly = (semi_latus_rectum / radius - 1) / e
+    if cos_anomaly < -1:
+        return None  # Apoapsis is below the altitude, only possible if the vehicle already is below it
+    # Descending means a negative flight path angle, i.e. a true anomaly between -pi and 0
+    return mean_anomaly(-math.acos(cos_anomaly), e)
+
+
+def burning(rocket):
+    """
+    :param rocket: An input rocket containing stage classes and fuel sub-classes.
+    :return: Returns True if the active stage would burn propellant at the current throttle setting
+    """
+    return sum(rocket_model.propellant_flow(rocket, rocket_model.throttle_setting(rocket))) > 0
+
+
+def can_coast(rocket):
+    """
+    :param rocket: An input rocket containing stage classes and fuel sub-classes.
+    :return: Returns True if the rocket is unpowered, above the atmosphere and moving sideways enough to follow a
+    Keplerian orbit that elements() can describe
+    """
+    if burning(rocket) or rocket.altitude < ATMOSPHERE_EDGE:
+        return False
+    try:
+        elements(rocket.altitude, rocket.velocity, math.radians(rocket.flight_path_angle))
+    except ValueError:
+        return False
+    return True
+
+
+class Coast:
+    """
+    Flies an unpowered rocket above the atmosphere along its Kepler orbit. Every update costs the same however far
+    ahead it goes, so the flight can be time-warped by any factor and jump straight to apoapsis or periapsis.
+    The coast ends, and the caller goes back to numerical integration, when the engines are throttled up or the
+    vehicle descends into the atmosphere.
+    """
+    def __init__(self, rocket, warp=1.0):
+        """
+        :param rocket: An input rocket containing stage classes and fuel sub-classes, see can_coast()
+        :param warp: Mission seconds flown per second passed to advance()
+        """
+        if not can_coast(rocket):
+            raise ValueError('the rocket must be unpowered and above ' + str(ATMOSPHERE_EDGE) + ' m to coast')
+        self.rocket = rocket
+        self.warp = warp
+        self.orbit = elements(rocket.altitude, rocket.velocity, math.radians(rocket.flight_path_angle), rocket.time)
+        self.entry_time = math.inf  # Mission time the vehicle reaches ATMOSPHERE_EDGE on the way down
+        entry = entry_mean_anomaly(self.orbit, ATMOSPHERE_EDGE)
+        if entry is not None:
+            wait = time_to_mean_anomaly(self.orbit, rocket.time, entry)
+            if wait is not None:
+                self.entry_time = rocket.time + wait
+
+    def set_time(self, mission_time):
+        """
+        This function moves the rocket to where it is on its orbit at mission_time.
+        :return: Nothing is returned
+        """
+        rocket = self.rocket
+        rocket.altitude, rocket.velocity, flight_path_angle = flight_state(self.orbit, mission_time)
+        rocket.flight_path_angle = math.degrees(flight_path_angle)
+        rocket.time = mission_time
+
+    def advance(self, delta_time):
+        """
+        This function coasts for delta_time scaled by the time-warp factor.
+        :param delta_time: Time in seconds before warping
+        :return: Returns None while coasting, "burn" if the engines are throttled up, the rocket is not moved then,
+        or "reentry" if the rocket reached the atmosphere, the rocket is left at the edge
+        """
+        if burning(self.rocket):
+            return "burn"
+        mission_time = self.rocket.time + delta_time * self.warp
+        if mission_time >= self.entry_time:
+            self.set_time(self.entry_time)
+            return "reentry"
+        self.set_time(mission_time)
+        return None
+
+    def jump_to(self, apsis):
+        """
+        This function skips ahead to the next apoapsis or periapsis, unless the atmosphere comes first.
+        :param apsis: "apoapsis" or "periapsis"
+        :return: Returns None if the rocket is at the apsis, "reentry" if the atmosphere came first or
+        "unreachable" for the apoapsis of an escape orbit or a periapsis already passed on one
+        """
+        wait = time_to_mean_anomaly(self.orbit, self.rocket.time, {"periapsis": 0.0, "apoapsis": math.pi}[apsis])
+        if wait is None or (apsis == "apoapsis" and self.orbit.eccentricity >= 1):
+            return "unreachable"
+        if self.rocket.time + wait >= self.entry_time:
+            self.set_time(self.entry_time)
+            return "reentry"
+        self.set_time(self.rocket.time + wait)
+        return None
@@ -0,0 +1,323 @@
+import time
+import threading
+import collections
+
+BUS_CLOCK = 100000  # Standard mode I2C clock [Hz]
+BITS_PER_BYTE = 9  # 8 data bits and the acknowledge bit
+FRAME_RATE = 50  # Byte budget periods per second
+UTILIZATION = 0.8  # Share of the bus the worker plans to use, the rest covers start/stop bits and retries
+FRAME_BYTES = 7  # Bytes of a full 4 digit frame: address, cursor command and position, four digits
+
+
+class ScheduledDisplay:
+    """
+    How often and how urgently a DisplayWorker writes one display, and what the writes cost.
+    """
+    def __init__(self, name, priority=0, refresh_rate=None, cost=FRAME_BYTES):
+        """
+        :param name: Name used in the statistics
+        :param priority: Higher priorities are written first
+        :param refresh_rate: Most writes per second, None for no limit
+        :param cost: Bytes one write puts on the bus
+        """
+        self.name = name
+        self.priority = priority
+        self.period = 0.0 if refresh_rate is None else 1.0 / refresh_rate
+        self.cost = cost
+
+        # -------------------VARIABLES-------------------
+        self.last_write = float('-inf')  # time.monotonic() of the last write
+        self.last_submitted = None  # time.monotonic() the value of the last write was submitted, None before any
+        self.deferred_frame = None  # Budget period in which the display was last deferred
+
+        # -------------------STATISTICS-------------------
+        self.writes = 0
+        self.errors = 0
+        self.deferred = 0  # Budget periods the display was due but its write did not fit
+        self.max_staleness = 0.0  # Longest a value waited before it was written [s]
+
+
+class DisplayWorker:
+    """
+    Writes to the displays of one I2C bus on a background thread. Pending writes are keyed by display and only the
+    newest value per display is kept, so a slow or retrying display never builds a backlog: by the time the bus is
+    free, stale values have been replaced by the latest one.
+
+    The bus is shared out in budget periods of 1 / frame_rate seconds, each allowed the bytes the bus clock can
+    carry in that time. A display is written no faster than its refresh rate, and among the displays that are due
+    the highest priority goes first. A display's priority rises with every refresh period it waits, and ties go to
+    the display written longest ago, so a burst on one display cannot starve the others.
+    """
+    def __init__(self, bus, bus_clock=BUS_CLOCK, frame_rate=FRAME_RATE, utilization=UTILIZATION):
+        """
+        :param bus: Name of the bus, used for the thread name
+        :param bus_clock: I2C clock in Hz
+        :param frame_rate: Budget periods per second
+        :param utilization: Share of the bus to plan for
+        """
+        self.bus = bus
+        self.frame_period = 1.0 / frame_rate
+        self.budget = int(bus_clock / BITS_PER_BYTE * self.frame_period * utilization)  # Bytes per period
+        self.displays = {}  # Display key: ScheduledDisplay
+        self.pending = collections.OrderedDict()  # Display key: (function, args, submit time), oldest first
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+        # -------------------VARIABLES-------------------
+        self.frame = 0  # Number of the current budget period
+        self.frame_start = float('-inf')  # time.monotonic() the current budget period started
+        self.frame_bytes = 0  # Bytes written in the current budget period
+
+        # -------------------STATISTICS-------------------
+        self.submitted = 0  # Values handed to submit()
+        self.written = 0  # Writes that completed
+        self.dropped = 0  # Values replaced by a newer one before they were written
+        self.errors = 0  # Writes that raised an exception
+        self.max_depth = 0  # Most displays waiting at once
+        self.total_latency = 0.0  # Sum of the time from submit() to the end of each write [s]
+        self.max_latency = 0.0  # Longest time from submit() to the end of a write [s]
+        self.bytes_sent = 0
+
+    def register(self, key, name=None, priority=0, refresh_rate=None, cost=FRAME_BYTES):
+        """
+        Sets how the display identified by key is scheduled. Displays that are not registered get priority 0, no
+        refresh limit and the cost of one 4 digit display.
+        :param key: Key the display's writes are submitted with
+        :param name: Name used in the statistics, str(key) by default
+        :param priority: Higher priorities are written first
+        :param refresh_rate: Most writes per second, None for no limit
+        :param cost: Bytes one write puts on the bus
+        :return: Returns the ScheduledDisplay
+        """
+        entry = ScheduledDisplay(str(key) if name is None else name, priority, refresh_rate, cost)
+        if entry.cost > self.budget:
+            raise ValueError('a write to ' + entry.name + ' needs ' + str(entry.cost) + ' bytes but bus ' +
+                             str(self.bus) + ' only carries ' + str(self.budget) + ' per period')
+        with self.condition:
+            self.displays[key] = entry
+        return entry
+
+    def start(self):
+        """
+        Starts the worker thread.
+        :return: Returns self so it can be chained after the constructor
+        """
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='display-bus-' + str(self.bus))
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the worker thread once the pending writes are done and waits for it to finish.
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def submit(self, key, function, *args):
+        """
+        Queues function(*args) as the next write to the display identified by key and returns at once. A write
+        already waiting for the same display is replaced, it keeps its place in the queue.
+        """
+        with self.condition:
+            if key not in self.displays:
+                self.displays[key] = ScheduledDisplay(str(key))
+            if key in self.pending:
+                self.dropped += 1
+                submitted = self.pending[key][2]
+            else:
+                submitted = time.monotonic()
+            # Latency is measured from the oldest value a write stands for
+            self.pending[key] = (function, args, submitted)
+            self.submitted += 1
+            self.max_depth = max(self.max_depth, len(self.pending))
+            self.condition.notify()
+
+    def depth(self):
+        """
+        :return: Returns the number of displays waiting to be written
+        """
+        return len(self.pending)
+
+    def next_write(self, now):
+        """
+        This function picks the display to write next. It is called with the condition held.
+        :param now: time.monotonic()
+        :return: Returns the key of the display to write and None, or None and the time in seconds until a display
+        may be written
+        """
+        if now - self.frame_start >= self.frame_period:
+            self.frame += 1
+            self.frame_start = now
+            self.frame_bytes = 0
+
+        # Half a budget period of slack so a display is not pushed back a whole period by timing jitter
+        earliest = now + 0.5 * self.frame_period
+        due = []
+        wait = float('inf')
+        for order, (key, (function, args, submitted)) in enumerate(self.pending.items()):
+            entry = self.displays[key]
+            if earliest - entry.last_write >= entry.period:
+                # Displays without a refresh limit age by budget periods
+                missed = (now - submitted) / max(entry.period, self.frame_period)
+                due.append((-(entry.priority + missed), entry.last_write, order, key))
+            else:
+                wait = min(wait, entry.last_write + entry.period - earliest)
+        due.sort()
+
+        for urgency, last_write, order, key in due:
+            entry = self.displays[key]
+            if self.frame_bytes + entry.cost <= self.budget:
+                return key, None
+            if entry.deferred_frame != self.frame:
+                entry.deferred_frame = self.frame
+                entry.deferred += 1
+        if due:
+            wait = self.frame_start + self.frame_period - now
+        return None, wait
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    if not self.pending:
+                        if not self.running:
+                            return
+                        self.condition.wait()
+                        continue
+                    now = time.monotonic()
+                    key, wait = self.next_write(now)
+                    if key is not None:
+                        break
+                    self.condition.wait(wait)
+                function, args, submitted = self.pending.pop(key)
+                entry = self.displays[key]
+                entry.last_write = now
+                entry.last_submitted = submitted
+                entry.max_staleness = max(entry.max_staleness, now - submitted)
+                self.frame_bytes += entry.cost
+                self.bytes_sent += entry.cost
+
+            # The bus is used outside the lock so submit() never waits on it
+            try:
+                function(*args)
+            except Exception as ex:
+                self.errors += 1
+                entry.errors += 1
+                print('display ' + entry.name + ' on bus ' + str(self.bus) + ' failed: ' + str(ex))
+            else:
+                self.written += 1
+                entry.writes += 1
+            latency = time.monotonic() - submitted
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def stats(self):
+        """
+        :return: Returns a dictionary of the worker's statistics, with the writes, errors, frames deferred for lack
+        of budget, current staleness and worst staleness in seconds of every display under 'displays', by name. The
+        current staleness is the age of the value waiting to be written, or of the last value written if none is
+        waiting, so a display that is being held back shows it before its write goes out. It is None for a display
+        that has neither.
+        """
+        completed = self.written + self.errors
+        with self.condition:
+            now = time.monotonic()
+            displays = {}
+            for key, entry in self.displays.items():
+                if key in self.pending:
+                    staleness = now - self.pending[key][2]
+                elif entry.last_submitted is not None:
+                    staleness = now - entry.last_submitted
+                else:
+                    staleness = None
+                displays[entry.name] = {'writes': entry.writes,
+                                        'errors': entry.errors,
+                                        'deferred': entry.deferred,
+                                        'staleness': staleness,
+                                        'max_staleness': entry.max_staleness}
+        return {'depth': self.depth(),
+                'max_depth': self.max_depth,
+                'submitted': self.submitted,
+                'written': self.written,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'mean_latency': self.total_latency / completed if completed else 0.0,
+                'max_latency': self.max_latency,
+                'bytes_sent': self.bytes_sent,
+                'displays': displays}
+
+
+class DisplayService:
+    """
+    Non-blocking front end for every display. Each bus gets its own DisplayWorker, started on first use, so one
+    flaky bus cannot hold up the others and no caller ever waits on I2C.
+    """
+    def __init__(self):
+        self.workers = {}  # Bus number: DisplayWorker
+
+    def worker(self, bus):
+        """
+        :return: Returns the worker of a bus, starting it if needed
+        """
+        if bus not in self.workers:
+            self.workers[bus] = DisplayWorker(bus)
+        if self.workers[bus].thread is None:
+            self.workers[bus].start()
+        return self.workers[bus]
+
+    def register(self, target, name=None, priority=0, refresh_rate=None, cost=None):
+        """
+        Sets how a display is scheduled on its bus, see DisplayWorker.register().
+        :param target: console.PropellantDisplay or SevenSegmentDisplay
+        :param name: Name used in the statistics, the display's address by default
+        :param priority: Higher priorities are written first
+        :param refresh_rate: Most writes per second, None for no limit
+        :param cost: Bytes one write puts on the bus, FRAME_BYTES per 4 digit display by default
+        :return: Returns the ScheduledDisplay
+        """
+        if hasattr(target, 'left_display'):
+            count = 2
+            default_name = hex(target.left_display.address) + '/' + hex(target.right_display.address)
+        else:
+            count = 1
+            default_name = hex(target.address)
+        return self.worker(target.busnum).register(target, default_name if name is None else name, priority,
+                                                   refresh_rate, count * FRAME_BYTES if cost is None else cost)
+
+    def submit(self, bus, key, function, *args):
+        """
+        Queues function(*args) on a bus, see DisplayWorker.submit(). Use this for writes that span several displays,
+        e.g. submit(2, (left, right), seven_segment_i2c.display_int, value, left, right).
+        """
+        self.worker(bus).submit(key, function, *args)
+
+    def display(self, target, value):
+        """
+        Shows a value on a console.PropellantDisplay or a SevenSegmentDisplay without waiting for the bus.
+        :param target: Display with a busnum attribute and a display() or write_int() method
+        :param value: Value to show
+        :return: Nothing is returned
+        """
+        write = target.display if hasattr(target, 'display') else target.write_int
+        self.submit(target.busnum, target, write, value)
+
+    def stop(self):
+        """
+        Finishes the pending writes and stops every worker. The statistics are kept, a later display() restarts
+        the worker of its bus.
+        """
+        for worker in self.workers.values():
+            worker.stop()
+
+    def stats(self):
+        """
+        :return: Returns a dictionary of DisplayWorker.stats() by bus
+        """
+        return dict((bus, worker.stats()) for bus, worker in self.workers.items())
@@ -0,0 +1,229 @@
+import os
+import copy
+import concurrent.futures
+import numpy
+import atmospheric_model as atmo
+import batch_simulator
+import pitch_program
+import rocket as rocket_model
+import staging
+
+DURATION = 600  # Default flight time, past core stage cutoff and upper stage ignition of the default vehicle [s]
+
+# Default pitch program, the best one pitch_program.optimize() finds for the default vehicle, in the order of
+# pitch_program.PARAMETERS
+PROGRAM = (135.0, 7.5, 0.8, 32.5)
+
+# One sigma dispersions as a fraction of the nominal value
+DISPERSIONS = {'THRUST': 0.01,
+               'ISP': 0.005,
+               'DRAG_COEFFICIENT': 0.05,
+               'DEAD_MASS': 0.01,
+               'PROPELLANT_MASS': 0.005}
+
+# Summary of one trajectory
+RESULT_TYPE = numpy.dtype([('altitude', numpy.float32),  # Final altitude [m]
+                           ('velocity', numpy.float32),  # Final velocity [m/s]
+                           ('flight_path_angle', numpy.float32),  # Final flight path angle [degrees]
+                           ('max_q', numpy.float32),  # Maximum dynamic pressure [kPa]
+                           ('srb_separation_time', numpy.float32),  # NaN if the SRBs were not dropped [s]
+                           ('burnout_time', numpy.float32),  # Time the core stage ran dry, NaN if it didn't [s]
+                           ('crashed', numpy.bool_)])  # True if the vehicle hit the ground, it is stopped there
+
+
+def perturb(batch, stage, random, dispersions):
+    """
+    This function applies random stage dispersions to every vehicle in a batch.
+    :param batch: BatchSimulator loaded with the nominal vehicle
+    :param stage: The nominal Stage the batch was loaded from
+    :param random: numpy.random.Generator to draw from
+    :param dispersions: Dictionary of one sigma dispersions, see DISPERSIONS
+    :return: Returns the dead mass in kg added to every vehicle, it is dropped along with the stage
+    """
+    def factor(name):
+        return 1 + dispersions.get(name, 0) * random.standard_normal(batch.count)
+
+    batch.parameters['THRUST_SCALE'] *= factor('THRUST')
+    batch.parameters['ISP_SCALE'] *= factor('ISP')
+
+    batch.parameters['DRAG_COEFFICIENT'] *= factor('DRAG_COEFFICIENT')
+
+    # The liquid propellant load is dispersed, the SRB grain is not
+    propellant = factor('PROPELLANT_MASS')
+    propellant_mass = (batch.tanks['fuel'] + batch.tanks['oxidizer']) * (propellant - 1)
+    batch.tanks['fuel'] *= propellant
+    batch.tanks['oxidizer'] *= propellant
+    dead_mass = stage.DEAD_MASS * (factor('DEAD_MASS') - 1)
+    batch.state[rocket_model.MASS] += dead_mass + propellant_mass
+    return dead_mass
+
+
+def timelines(rocket, count):
+    """
+    This function gives every vehicle of a batch its own copy of the rocket to stage with. The copies share the
+    rocket's engine tables, so the batch still sees one stage per stage name.
+    :param rocket: The rocket the batch was loaded from
+    :param count: Number of vehicles
+    :return: Returns a list of StagingEngines, one per vehicle
+    """
+    shared = {}
+    for name in rocket.stages:
+        stage = getattr(rocket, name)
+        for table in (stage.engine, stage.srb_engine):
+            if table is not None:
+                shared[id(table)] = table
+    return [staging.StagingEngine(copy.deepcopy(rocket, dict(shared))) for _ in range(count)]
+
+
+def empty_tanks(batch):
+    """
+    :param batch: BatchSimulator
+    :return: Returns the number of empty tanks of every vehicle's active stage, a stage without SRBs counts one
+    """
+    return (batch.tanks['fuel'] <= 0).astype(int) + (batch.tanks['oxidizer'] <= 0) + (batch.tanks['srb'] <= 0)
+
+
+def stage_vehicle(batch, sequence, vehicle_index):
+    """
+    This function brings one vehicle's staging timeline up to the batch and stages the vehicle if an event is due.
+    The timeline only tracks tanks, its flight is not integrated.
+    :param batch: BatchSimulator
+    :param sequence: The vehicle's StagingEngine
+    :param vehicle_index: Column of the vehicle in the batch
+    :return: Returns the names of the events that fired
+    """
+    rocket = sequence.rocket
+    active = rocket.stage
+    for name in batch_simulator.TANKS:
+        tank = getattr(active, name)
+        if tank is not None:
+            tank.mass = batch.tanks[name][vehicle_index]
+    rocket.time = batch.time
+    rocket.altitude = batch.altitude[vehicle_index]
+    mass = rocket_model.vehicle_mass(rocket)
+    fired = sequence.fire_due()
+    if rocket.stage is not active:
+        batch.set_stage(rocket, rocket.mass - mass, vehicle_index)
+    return fired
+
+
+def run_chunk(seed, chunk_index, count, duration, delta_time, dispersions, program=PROGRAM):
+    """
+    This function flies one chunk of dispersed trajectories from the pad with full tanks along a pitch program. It
+    runs inside a worker process. The random stream is seeded from (seed, chunk_index) so results do not depend on
+    which worker runs the chunk. Dispersed vehicles run dry at different times, so each one stages on its own
+    StagingEngine timeline. A vehicle that goes below the ground is stopped there for the rest of the flight.
+    :param seed: Seed of the whole sweep
+    :param chunk_index: Index of this chunk in the sweep
+    :param count: Number of trajectories in this chunk
+    :param duration: Flight time in seconds
+    :param delta_time: Time step in seconds
+    :param dispersions: Dictionary of one sigma dispersions, see DISPERSIONS
+    :param program: Pitch program flown by every vehicle, see pitch_program.PARAMETERS
+    :return: Returns the chunk index and a RESULT_TYPE array with one entry per trajectory
+    """
+    random = numpy.random.default_rng([seed, chunk_index])
+    rocket = rocket_model.load_rocket(hardware=False)
+    rocket_model.fill_tanks(rocket)
+    batch = batch_simulator.load_batch(count, rocket)
+    dead_mass = perturb(batch, rocket.stage, random, dispersions)
+    sequences = timelines(rocket, count)
+    guidance = pitch_program.PitchProgram(numpy.tile(program, (count, 1)))
+
+    max_q = numpy.zeros(count)
+    crashed = numpy.zeros(count, dtype=bool)
+    stopped = numpy.zeros_like(batch.state)  # State of the crashed vehicles, on the ground
+    empty = empty_tanks(batch)
+    due = numpy.full(count, numpy.inf)  # Time of each timeline's next queued event
+    for i in range(int(round(duration / delta_time))):
+        guidance.steer(batch)
+        batch.step(delta_time)
+
+        # Only vehicles with a tank that just ran dry or a queued event that is due have anything to stage
+        now_empty = empty_tanks(batch)
+        for vehicle_index in numpy.flatnonzero(((now_empty != empty) | (due <= batch.time + 1e-9)) & ~crashed):
+            sequence = sequences[vehicle_index]
+            if stage_vehicle(batch, sequence, vehicle_index) and dead_mass[vehicle_index] != 0:
+                if sequence.rocket.current_stage != rocket.current_stage:
+                    # The dispersed dead mass goes with the stage it belongs to
+                    batch.state[rocket_model.MASS, vehicle_index] -= dead_mass[vehicle_index]
+                    dead_mass[vehicle_index] = 0
+            next_time = sequence.next_time()
+            due[vehicle_index] = numpy.inf if next_time is None else next_time
+        empty = empty_tanks(batch)
+
+        guidance.pitch(batch, delta_time)
+        impact = ~crashed & (batch.altitude < 0)
+        if impact.any():
+            stopped[:, impact] = batch.state[:, impact]
+            stopped[rocket_model.ALTITUDE, impact] = 0
+            stopped[rocket_model.VELOCITY, impact] = 0
+            crashed |= impact
+        batch.state[:, crashed] = stopped[:, crashed]
+        max_q = numpy.maximum(max_q, 0.5 * atmo.lookup_array(batch.altitude).density * batch.velocity ** 2 / 1000)
+        if crashed.all():
+            break
+
+    results = numpy.empty(count, dtype=RESULT_TYPE)
+    results['altitude'] = batch.altitude
+    results['velocity'] = batch.velocity
+    results['flight_path_angle'] = numpy.degrees(batch.flight_path_angle)
+    results['max_q'] = max_q
+    for field, event in (('srb_separation_time', 'srb_separation'), ('burnout_time', 'core_meco')):
+        results[field] = [next((time for time, name in sequence.history if name == event), numpy.nan)
+                          for sequence in sequences]
+    results['crashed'] = crashed
+    return chunk_index, results
+
+
+def run_stream(runs, duration=DURATION, delta_time=0.1, seed=0, chunk_size=250, dispersions=None, workers=None,
+               program=PROGRAM):
+    """
+    This function farms a dispersion sweep across a process pool and yields results as chunks finish.
+    :param runs: Total number of trajectories
+    :param duration: Flight time in seconds
+    :param delta_time: Time step in seconds
+    :param seed: Seed of the whole sweep, the same seed always gives the same results
+    :param chunk_size: Trajectories per chunk, each chunk is one vectorized batch
+    :param dispersions: Dictionary of one sigma dispersions, DISPERSIONS by default
+    :param workers: Number of worker processes, all cores by default
+    :param program: Pitch program flown by every vehicle, see pitch_program.PARAMETERS
+    :return: Yields (chunk_index, RESULT_TYPE array) in completion order, chunk i holds runs
+    i * chunk_size onwards
+    """
+    if dispersions is None:
+        dispersions = DISPERSIONS
+    if workers is None:
+        workers = os.cpu_count()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_chunk, seed, chunk_index, min(chunk_size, runs - start), duration, delta_time,
+                                   dispersions, program)
+                   for chunk_index, start in enumerate(range(0, runs, chunk_size))]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+
+def run(runs, duration=DURATION, delta_time=0.1, seed=0, chunk_size=250, dispersions=None, workers=None,
+        program=PROGRAM):
+    """
+    This function runs a dispersion sweep and collects the results in run order. See run_stream() for parameters.
+    :return: Returns a RESULT_TYPE array with one entry per trajectory
+    """
+    results = numpy.empty(runs, dtype=RESULT_TYPE)
+    for chunk_index, chunk in run_stream(runs, duration, delta_time, seed, chunk_size, dispersions, workers,
+                                         program):
+        results[chunk_index * chunk_size:chunk_index * chunk_size + len(chunk)] = chunk
+    return results
+
+
+def main():
+    results = run(1000)
+    for name in RESULT_TYPE.names:
+        if name != 'crashed':
+            print('{0:>19}: {1}'.format(name, numpy.nanpercentile(results[name], [1, 50, 99])))
+    print('{0:>19}: {1} of {2}'.format('crashed', numpy.count_nonzero(results['crashed']), len(results)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+import os
+import concurrent.futures
+import numpy
+import atmospheric_model as atmo
+import batch_simulator
+import coast
+import rocket as rocket_model
+import staging
+import vehicle
+
+# A pitch program is a vertical climb until KICK_VELOCITY, a pitch-over of KICK_ANGLE degrees at PITCH_RATE, and a
+# gravity turn from there on. Once above the atmosphere the thrust is held VACUUM_PITCH degrees above the local
+# horizon. Each parameter is searched between its bounds.
+PARAMETERS = ['KICK_VELOCITY', 'KICK_ANGLE', 'PITCH_RATE', 'VACUUM_PITCH']
+BOUNDS = {'KICK_VELOCITY': (10.0, 150.0),  # [m/s]
+          'KICK_ANGLE': (0.5, 20.0),  # [degrees]
+          'PITCH_RATE': (0.1, 2.0),  # [degrees/s]
+          'VACUUM_PITCH': (-10.0, 60.0)}  # [degrees]
+
+MAX_Q = 40.0  # Largest dynamic pressure a trajectory may reach [kPa]
+DURATION = 1800  # Default longest flight, past the point where every default trajectory has fallen back [s]
+INSERTION_ALTITUDE = 100000.0  # Periapsis altitude at which a vehicle counts as in orbit [m]
+
+# Summary of one candidate trajectory, flown through staging until it reaches orbit. Without an orbit target the
+# "insertion" fields describe the point of highest orbital energy instead.
+RESULT_TYPE = numpy.dtype([('KICK_VELOCITY', numpy.float64),
+                           ('KICK_ANGLE', numpy.float64),
+                           ('PITCH_RATE', numpy.float64),
+                           ('VACUUM_PITCH', numpy.float64),
+                           ('score', numpy.float64),  # Higher is better, see score()
+                           ('violation', numpy.float64),  # How far the limits were broken, 0 if they were kept
+                           ('insertion_mass', numpy.float64),  # Mass in orbit, 0 if orbit was not reached [kg]
+                           ('insertion_time', numpy.float64),  # NaN if orbit was not reached [s]
+                           ('periapsis', numpy.float64),  # Highest periapsis altitude reached until insertion [m]
+                           ('energy', numpy.float64),  # Specific orbital energy at insertion [J/kg]
+                           ('losses', numpy.float64),  # Gravity and drag losses until insertion [m/s]
+                           ('altitude', numpy.float64),  # At insertion [m]
+                           ('velocity', numpy.float64),  # At insertion [m/s]
+                           ('flight_path_angle', numpy.float64),  # At insertion [degrees]
+                           ('max_q', numpy.float64),  # Highest dynamic pressure on the way out of the atmosphere [kPa]
+                           ('crashed', numpy.bool_)])  # True if the vehicle went below the ground
+
+
+def periapsis_altitude(batch):
+    """
+    :param batch: BatchSimulator
+    :return: Returns every vehicle's periapsis altitude in meters if its engines stopped now, -EARTH_RADIUS for
+    vertical flight
+    """
+    radius = atmo.EARTH_RADIUS + batch.altitude
+    angular_momentum = radius * batch.velocity * numpy.cos(batch.flight_path_angle)
+    energy = batch.velocity ** 2 / 2 - coast.MU / radius
+    eccentricity = numpy.sqrt(numpy.maximum(1 + 2 * energy * angular_momentum ** 2 / coast.MU ** 2, 0))
+    return angular_momentum ** 2 / coast.MU / (1 + eccentricity) - atmo.EARTH_RADIUS
+
+
+class PitchProgram:
+    """
+    Steers every vehicle of a batch along its own pitch program, see PARAMETERS. Call steer() before each batch step
+    and pitch() after it.
+    """
+    def __init__(self, candidates):
+        """
+        :param candidates: Array of shape (count, len(PARAMETERS)), one pitch program per vehicle
+        """
+        candidates = numpy.asarray(candidates, dtype=float)
+        self.kick_velocity = candidates[:, 0]
+        self.kick_angle = numpy.radians(candidates[:, 1])
+        self.pitch_rate = numpy.radians(candidates[:, 2])
+        self.vacuum_pitch = numpy.radians(candidates[:, 3])
+        self.pitched = numpy.zeros(len(candidates))  # Pitch-over done so far [rad]
+        self.left_atmosphere = numpy.zeros(len(candidates), dtype=bool)
+
+    def steer(self, batch):
+        """
+        This function points the thrust for the coming step. The gravity turn alone leaves the upper stages climbing,
+        in vacuum the thrust is pitched down instead.
+        :param batch: BatchSimulator
+        :return: Nothing is returned
+        """
+        batch.steering = numpy.where(self.left_atmosphere, self.vacuum_pitch - batch.flight_path_angle, 0)
+
+    def pitch(self, batch, delta_time):
+        """
+        This function applies the vertical climb and the pitch-over after a step.
+        :param batch: BatchSimulator
+        :param delta_time: Time step in seconds
+        :return: Nothing is returned
+        """
+        kicking = (batch.velocity >= self.kick_velocity) & (self.pitched < self.kick_angle)
+        change = numpy.where(kicking, numpy.minimum(self.pitch_rate * delta_time, self.kick_angle - self.pitched), 0)
+        batch.state[rocket_model.FLIGHT_PATH_ANGLE] -= change
+        # The climb is held vertical until the kick, however the vehicle was set up on the pad
+        batch.state[rocket_model.FLIGHT_PATH_ANGLE][(self.pitched == 0) & ~kicking] = numpy.pi / 2
+        self.pitched += change
+        self.left_atmosphere |= batch.altitude >= coast.ATMOSPHERE_EDGE
+
+
+def fly(batch, rocket, candidates, duration, delta_time, insertion_altitude=INSERTION_ALTITUDE):
+    """
+    This function flies one pitch program per vehicle through the staging sequence until every vehicle has reached
+    orbit or crashed, or duration has passed. Every vehicle burns at full throttle, so their tanks run dry at the
+    same steps and a single rocket, drained alongside the batch by a StagingEngine, says when to stage. Without an
+    orbit target each vehicle flies until it crashes and is described where its orbital energy peaked.
+    :param batch: BatchSimulator loaded from rocket, one vehicle per candidate
+    :param rocket: The rocket the batch was loaded from, on the pad with full tanks
+    :param candidates: Array of shape (count, len(PARAMETERS))
+    :param duration: Longest flight time in seconds
+    :param delta_time: Time step in seconds
+    :param insertion_altitude: Periapsis altitude in meters at which a vehicle counts as in orbit, None for no orbit
+    target
+    :return: Returns a RESULT_TYPE array with score left at zero
+    """
+    sequence = staging.StagingEngine(rocket)
+    program = PitchProgram(candidates)
+    max_q = numpy.zeros(batch.count)
+    losses = numpy.zeros(batch.count)
+    periapsis = numpy.full(batch.count, -atmo.EARTH_RADIUS)
+    crashed = numpy.zeros(batch.count, dtype=bool)
+    stopped = numpy.zeros_like(batch.state)  # State of the crashed vehicles, on the ground
+    inserted = numpy.zeros(batch.count, dtype=bool)
+    results = numpy.zeros(batch.count, dtype=RESULT_TYPE)
+    results['insertion_time'] = numpy.nan
+    peak_energy = numpy.full(batch.count, -numpy.inf)
+
+    for i in range(int(round(duration / delta_time))):
+        # Losses are the velocity the engines gave that did not end up as speed
+        atmosphere = atmo.lookup_array(batch.altitude)
+        drag = 0.5 * atmosphere.density * batch.velocity ** 2 * batch.parameters['AREA'] * \
+            batch.parameters['DRAG_COEFFICIENT']
+        powered = batch.burning() & ~inserted & ~crashed
+        losses += powered * (atmosphere.gravity * numpy.sin(batch.flight_path_angle) + drag / batch.mass) * delta_time
+        # Only the climb out of the atmosphere is limited, a vehicle that missed orbit may fall back through it
+        climbing = ~program.left_atmosphere & ~crashed
+        max_q[climbing] = numpy.maximum(max_q, 0.5 * atmosphere.density * batch.velocity ** 2 / 1000)[climbing]
+
+        program.steer(batch)
+        batch.step(delta_time)
+        # Only the tanks of the timeline matter, its flight is not integrated
+        rocket_model.set_propellant_flow(rocket, rocket_model.throttle_setting(rocket))
+        rocket_model.drain_propellant(rocket, delta_time)
+        rocket.time += delta_time
+        mass = rocket.mass
+        if sequence.fire_due():
+            batch.set_stage(rocket, rocket.mass - mass)
+        program.pitch(batch, delta_time)
+        # A vehicle that hits the ground is stopped there
+        impact = ~crashed & (batch.altitude < 0)
+        stopped[:, impact] = batch.state[:, impact]
+        stopped[rocket_model.ALTITUDE, impact] = 0
+        stopped[rocket_model.VELOCITY, impact] = 0
+        crashed |= impact
+        batch.state[:, crashed] = stopped[:, crashed]
+
+        flying = ~inserted & ~crashed
+        periapsis[flying] = numpy.maximum(periapsis[flying], periapsis_altitude(batch)[flying])
+        if insertion_altitude is None:
+            # No vehicle is ever done, each one keeps the state where its energy peaked until it crashes
+            energy = batch.velocity ** 2 / 2 - coast.MU / (atmo.EARTH_RADIUS + batch.altitude)
+            peaked = flying & (energy > peak_energy)
+            peak_energy[peaked] = energy[peaked]
+            results['insertion_mass'][peaked] = batch.mass[peaked]
+            results['insertion_time'][peaked] = batch.time
+            results['altitude'][peaked] = batch.altitude[peaked]
+            results['velocity'][peaked] = batch.velocity[peaked]
+            results['flight_path_angle'][peaked] = numpy.degrees(batch.flight_path_angle[peaked])
+            if crashed.all():
+                break
+            continue
+        reached = flying & (periapsis >= insertion_altitude)
+        results['insertion_mass'][reached] = batch.mass[reached]
+        results['insertion_time'][reached] = batch.time
+        results['altitude'][reached] = batch.altitude[reached]
+        results['velocity'][reached] = batch.velocity[reached]
+        results['flight_path_angle'][reached] = numpy.degrees(batch.flight_path_angle[reached])
+        inserted |= reached
+        if (inserted | crashed).all():
+            break
+
+    # Vehicles that did not reach orbit are described where they ended up
+    ended = ~inserted if insertion_altitude is not None else numpy.zeros(batch.count, dtype=bool)
+    results['altitude'][ended] = batch.altitude[ended]
+    results['velocity'][ended] = batch.velocity[ended]
+    results['flight_path_angle'][ended] = numpy.degrees(batch.flight_path_angle[ended])
+
+    for column, name in enumerate(PARAMETERS):
+        results[name] = candidates[:, column]
+    results['periapsis'] = periapsis
+    results['energy'] = results['velocity'] ** 2 / 2 - coast.MU / (atmo.EARTH_RADIUS + results['altitude'])
+    results['losses'] = losses
+    results['max_q'] = max_q
+    results['crashed'] = crashed
+    return results
+
+
+def score(results, objective, max_q=MAX_Q, insertion_altitude=INSERTION_ALTITUDE):
+    """
+    This function rates candidate trajectories in place. Candidates are ranked by violation first and score second,
+    so the search is pulled towards trajectories that keep the limits and reach orbit before it optimizes among them.
+    :param results: RESULT_TYPE array from fly()
+    :param objective: "mass" to maximize the mass put into orbit, "energy" to maximize the orbital energy at
+    insertion or "losses" to minimize gravity and drag losses
+    :param max_q: Largest allowed dynamic pressure in kPa
+    :param insertion_altitude: Periapsis altitude in meters fly() was run with, None if it had no orbit target
+    :return: Returns results
+    """
+    if objective == 'mass':
+        results['score'] = results['insertion_mass']
+    elif objective == 'energy':
+        results['score'] = results['energy']
+    elif objective == 'losses':
+        results['score'] = -results['losses']
+    else:
+        raise ValueError('objective must be "mass", "energy" or "losses", got ' + repr(objective))
+    results['violation'] = numpy.maximum(results['max_q'] / max_q - 1, 0)
+    if insertion_altitude is not None:
+        # The periapsis shortfall is measured from the centre of the Earth so it stays between 0 and 1. A vehicle that
+        # crashed never reached orbit, so the shortfall covers it too
+        results['violation'] += numpy.maximum(1 - (atmo.EARTH_RADIUS + results['periapsis']) /
+                                              (atmo.EARTH_RADIUS + insertion_altitude), 0)
+    return results
+
+
+def rank(results):
+    """
+    :param results: Scored RESULT_TYPE array
+    :return: Returns results sorted best first
+    """
+    return results[numpy.lexsort((-results['score'], results['violation']))]
+
+
+def evaluate(definition_file, candidates, duration, delta_time, objective, max_q, insertion_altitude):
+    """
+    This function flies a chunk of candidates as one batch from the pad with full tanks. It runs inside a worker
+    process.
+    :return: Returns a scored RESULT_TYPE array, one entry per candidate
+    """
+    rocket = rocket_model.load_rocket(hardware=False, definition_file=definition_file)
+    rocket_model.fill_tanks(rocket)
+    batch = batch_simulator.load_batch(len(candidates), rocket)
+    return score(fly(batch, rocket, candidates, duration, delta_time, insertion_altitude), objective, max_q,
+                 insertion_altitude)
+
+
+def optimize(definition_file=vehicle.DEFAULT_VEHICLE, objective='energy', population=400, generations=15,
+             elite_fraction=0.1, duration=DURATION, delta_time=0.5, seed=0, chunk_size=100, workers=None, max_q=MAX_Q,
+             insertion_altitude=None):
+    """
+    This function searches for the best pitch program with the cross-entropy method: every generation samples
+    candidates around the best ones of the last, and each generation's candidates are flown in parallel chunks.
+    :param definition_file: Vehicle definition to optimize for
+    :param objective: "mass", "energy" or "losses", see score()
+    :param population: Candidates per generation
+    :param generations: Number of generations
+    :param elite_fraction: Fraction of each generation the next one is sampled around
+    :param duration: Longest flight time in seconds
+    :param delta_time: Time step in seconds
+    :param seed: Seed of the search, the same seed always gives the same result
+    :param chunk_size: Candidates per chunk, each chunk is one vectorized batch
+    :param workers: Number of worker processes, all cores by default
+    :param max_q: Largest allowed dynamic pressure in kPa
+    :param insertion_altitude: Periapsis altitude in meters at which a vehicle counts as in orbit. None, the default,
+    sets no orbit target, because the default vehicle cannot reach orbit: trajectories are then rated at their energy
+    peak and only the dynamic pressure limit applies
+    :return: Returns the best RESULT_TYPE entry found and a list of the best entry of every generation
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    random = numpy.random.default_rng(seed)
+    low = numpy.array([BOUNDS[name][0] for name in PARAMETERS])
+    high = numpy.array([BOUNDS[name][1] for name in PARAMETERS])
+    mean = (low + high) / 2
+    deviation = (high - low) / 2
+    elite_count = max(int(population * elite_fraction), 2)
+    best = None
+    history = []
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for generation in range(generations):
+            candidates = numpy.clip(mean + deviation * random.standard_normal((population, len(PARAMETERS))), low,
+                                    high)
+            futures = [executor.submit(evaluate, definition_file, candidates[start:start + chunk_size], duration,
+                                       delta_time, objective, max_q, insertion_altitude)
+                       for start in range(0, population, chunk_size)]
+            results = numpy.concatenate([future.result() for future in futures])
+
+            ranked = rank(results)
+            history.append(ranked[0].copy())
+            # Compared by the ranking key, whole records never compare equal while insertion_time is NaN
+            if best is None or (ranked[0]['violation'], -ranked[0]['score']) < (best['violation'], -best['score']):
+                best = ranked[0].copy()
+
+            elite = ranked[:elite_count]
+            elite_parameters = numpy.column_stack([elite[name] for name in PARAMETERS])
+            mean = elite_parameters.mean(axis=0)
+            deviation = numpy.maximum(elite_parameters.std(axis=0), (high - low) * 1e-3)
+    return best, history
+
+
+def main():
+    best, history = optimize()
+    for generation, result in enumerate(history):
+        print('{0:>3}: score {1:.6g} violation {2:.3g}'.format(generation, result['score'], result['violation']))
+    for name in RESULT_TYPE.names:
+        print('{0:>18}: {1:.6g}'.format(name, best[name]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+import time
+import math
+import numpy
+import atmospheric_model as atmo
+import rocket as rocket_model
+
+# -------------------DORMAND-PRINCE-5(4)-TABLEAU-------------------
+C = [0, 1 / 5.0, 3 / 10.0, 4 / 5.0, 8 / 9.0, 1, 1]
+A = [[],
+     [1 / 5.0],
+     [3 / 40.0, 9 / 40.0],
+     [44 / 45.0, -56 / 15.0, 32 / 9.0],
+     [19372 / 6561.0, -25360 / 2187.0, 64448 / 6561.0, -212 / 729.0],
+     [9017 / 3168.0, -355 / 33.0, 46732 / 5247.0, 49 / 176.0, -5103 / 18656.0],
+     [35 / 384.0, 0, 500 / 1113.0, 125 / 192.0, -2187 / 6784.0, 11 / 84.0]]
+# Difference between the 5th and the embedded 4th order weights, used as the local error estimate
+E = [71 / 57600.0, 0, -71 / 16695.0, 71 / 1920.0, -17253 / 339200.0, 22 / 525.0, -1 / 40.0]
+
+SAFETY = 0.9  # Safety factor applied to the optimal step size
+MIN_FACTOR = 0.2  # Largest allowed shrink of the step size in one go
+MAX_FACTOR = 10.0  # Largest allowed growth of the step size in one go
+MIN_STEP = 1e-9  # Smallest step size tried before giving up [s]
+
+# Default tolerances for the rocket state vector [altitude, velocity, flight path angle, mass]
+RELATIVE_TOLERANCE = 1e-6
+ABSOLUTE_TOLERANCE = numpy.array([1e-3, 1e-4, 1e-8, 1e-2])
+
+
+class Event:
+    """
+    A condition that the integrator locates exactly. The event fires when function(time, state) crosses zero in the
+    given direction (+1 rising, -1 falling, 0 either).
+    """
+    def __init__(self, name, function, direction=0):
+        self.name = name
+        self.function = function
+        self.direction = direction
+
+    def triggered(self, value_old, value_new):
+        """
+        :return: Returns True if the event function crossed zero in the requested direction between the two values
+        """
+        if self.direction >= 0 and value_old < 0 <= value_new:
+            return True
+        if self.direction <= 0 and value_old > 0 >= value_new:
+            return True
+        return False
+
+
+def dormand_prince_step(derivative, time_old, state, delta_time, k1):
+    """
+    This function takes one Dormand-Prince 5(4) step.
+    :param derivative: Function f(time, state) returning d(state)/dt
+    :param time_old: Time at the start of the step
+    :param state: State vector at the start of the step
+    :param delta_time: Step size
+    :param k1: f(time_old, state), reused from the end of the previous step
+    :return: Returns the new state, the derivative at the new state and the local error estimate. The error is
+    infinite if a stage left the finite numbers, the derivative is never evaluated on such a state.
+    """
+    k = [k1]
+    for i in range(1, 7):
+        increment = sum(a * ki for a, ki in zip(A[i], k) if a != 0)
+        stage_state = state + delta_time * increment
+        if not numpy.isfinite(stage_state).all():
+            return stage_state, None, numpy.full_like(state, numpy.inf)
+        k.append(derivative(time_old + C[i] * delta_time, stage_state))
+    error = delta_time * sum(e * ki for e, ki in zip(E, k) if e != 0)
+    return stage_state, k[6], error
+
+
+def error_norm(error, state_old, state_new, relative_tolerance, absolute_tolerance):
+    """
+    :return: Returns the RMS of the local error scaled by the mixed absolute/relative tolerance
+    """
+    scale = absolute_tolerance + relative_tolerance * numpy.maximum(numpy.abs(state_old), numpy.abs(state_new))
+    return math.sqrt(numpy.mean((error / scale) ** 2))
+
+
+def locate_event(derivative, time_old, state, k1, delta_time, event, value_old, value_new, time_tolerance):
+    """
+    This function finds the step size that lands on an event using the Illinois variant of regula falsi.
+    :return: Returns the step size, the state at the event and the number of derivative evaluations used
+    """
+    low, high = 0.0, delta_time
+    value_low, value_high = value_old, value_new
+    side = 0
+    evaluations = 0
+    state_event = None
+    while high - low > time_tolerance:
+        trial = (low * value_high - high * value_low) / (value_high - value_low)
+        trial = min(max(trial, low + 0.5 * time_tolerance), high - 0.5 * time_tolerance)
+        state_event = dormand_prince_step(derivative, time_old, state, trial, k1)[0]
+        evaluations += 6
+        value = event.function(time_old + trial, state_event)
+        if (value < 0) == (value_low < 0):
+            low, value_low = trial, value
+            if side == -1:
+                value_high *= 0.5
+            side = -1
+        else:
+            high, value_high = trial, value
+            if side == 1:
+                value_low *= 0.5
+            side = 1
+
+    # Land just past the crossing so the event condition holds in the returned state
+    state_event = dormand_prince_step(derivative, time_old, state, high, k1)[0]
+    return high, state_event, evaluations + 6
+
+
+def integrate(derivative, time_start, state, time_end, events=(), relative_tolerance=RELATIVE_TOLERANCE,
+              absolute_tolerance=ABSOLUTE_TOLERANCE, first_step=1.0, max_step=numpy.inf, time_tolerance=1e-6, k1=None):
+    """
+    This function integrates d(state)/dt = derivative(time, state) with adaptive Dormand-Prince 5(4) steps until
+    time_end or until the first event fires.
+    :param derivative: Function f(time, state) returning d(state)/dt
+    :param time_start: Start time in seconds
+    :param state: State vector at time_start
+    :param time_end: End time in seconds
+    :param events: List of Event objects that stop the integration when they fire
+    :param relative_tolerance: Relative error allowed per step
+    :param absolute_tolerance: Absolute error allowed per step, a scalar or one value per state component
+    :param first_step: Initial step size in seconds
+    :param max_step: Largest allowed step size in seconds
+    :param time_tolerance: Accuracy of the located event times in seconds
+    :param k1: d(state)/dt at time_start if the caller already evaluated it
+    :return: Returns the final time, the final state, the Event that fired (None if time_end was reached), the
+    suggested next step size, the number of accepted steps and the number of derivative evaluations
+    """
+    current_time = time_start
+    state = numpy.asarray(state, dtype=float)
+    delta_time = min(first_step, max_step)
+    evaluations = 0
+    if k1 is None:
+        k1 = derivative(current_time, state)
+        evaluations = 1
+    event_values = [event.function(current_time, state) for event in events]
+    steps = 0
+
+    while current_time < time_end:
+        delta_time = min(delta_time, time_end - current_time)
+        state_new, k_new, error = dormand_prince_step(derivative, current_time, state, delta_time, k1)
+        evaluations += 6
+        norm = error_norm(error, state, state_new, relative_tolerance, absolute_tolerance)
+
+        if not norm <= 1:
+            # Reject the step and retry with a smaller one. A NaN or infinite norm means the trial step left the
+            # finite numbers, which only a smaller step can fix.
+            delta_time *= max(MIN_FACTOR, SAFETY * norm ** -0.2) if math.isfinite(norm) else MIN_FACTOR
+            if delta_time < MIN_STEP:
+                raise RuntimeError('step size fell below ' + str(MIN_STEP) + ' s at t = ' + str(current_time))
+            continue
+
+        steps += 1
+        factor = MAX_FACTOR if norm == 0 else min(MAX_FACTOR, SAFETY * norm ** -0.2)
+        next_step = min(delta_time * factor, max_step)
+
+        # Find the earliest event that fired inside this step
+        fired = None
+        new_values = [event.function(current_time + delta_time, state_new) for event in events]
+        for event, value_old, value_new in zip(events, event_values, new_values):
+            if event.triggered(value_old, value_new):
+                event_step, event_state, used = locate_event(derivative, current_time, state, k1, delta_time, event,
+                                                             value_old, value_new, time_tolerance)
+                evaluations += used
+                if fired is None or event_step < fired[1]:
+                    fired = (event, event_step, event_state)
+
+        if fired is not None:
+            event, event_step, event_state = fired
+            return current_time + event_step, event_state, event, next_step, steps, evaluations
+
+        current_time += delta_time
+        state = state_new
+        k1 = k_new
+        event_values = new_values
+        delta_time = next_step
+
+    return current_time, state, None, delta_time, steps, evaluations
+
+
+def rocket_events(rocket, separation_time=None):
+    """
+    This function builds the staging events for the rocket's current stage. Tank flows are constant during a
+    propagation, see set_propellant_flow(), so the tanks run dry at known times.
+    :param rocket: An input rocket containing stage classes and fuel sub-classes.
+    :param separation_time: Mission time of the next stage separation in seconds, None if none is planned
+    :return: Returns a list of Event objects
+    """
+    stage = rocket.stage
+    events = []
+
+    if stage.fuel.flow_rate > 0:
+        depletion_time = rocket.time + min(stage.fuel.mass / stage.fuel.flow_rate,
+                                           stage.oxidizer.mass / stage.oxidizer.flow_rate)
+        events.append(Event("propellant_depletion", lambda t, y: t - depletion_time, 1))
+
+    if stage.srb is not None and stage.srb.flow_rate > 0:
+        srb_burnout_time = rocket.time + stage.srb.mass / stage.srb.flow_rate
+        events.append(Event("srb_burnout", lambda t, y: t - srb_burnout_time, 1))
+
+    if separation_time is not None:
+        events.append(Event("stage_separation", lambda t, y: t - separation_time, 1))
+
+    return events
+
+
+def propagate(rocket, duration, separation_time=None, relative_tolerance=RELATIVE_TOLERANCE,
+              absolute_tolerance=ABSOLUTE_TOLERANCE, max_step=numpy.inf, events=()):
+    """
+    This function advances the rocket with adaptive Dormand-Prince steps. The throttle is sampled once at the start.
+    Thrust follows the ambient pressure smoothly, so the integration only stops at propellant depletion, SRB burnout,
+    stage separation and the caller's own events, where the caller can stage. A rocket with a recorder gets one
+    record per call, for the state it starts from.
+    :param rocket: An input rocket containing stage classes and fuel sub-classes.
+    :param duration: Time to propagate in seconds
+    :param separation_time: Mission time of the next stage separation in seconds, None if none is planned
+    :param relative_tolerance: Relative error allowed per step
+    :param absolute_tolerance: Absolute error allowed per step, one value per state component
+    :param max_step: Largest allowed step size in seconds
+    :param events: Extra Event objects to stop on, e.g. the altitude conditions of a StagingEngine
+    :return: Returns the name of the event that stopped the integration, None if the full duration was flown, and
+    the number of derivative evaluations
+    """
+    start = time.perf_counter()
+    throttle = rocket_model.throttle_setting(rocket)
+    mass_flow, liquid_throttle, srb_throttle = rocket_model.set_propellant_flow(rocket, throttle)
+
+    def derivative(t, y):
+        return rocket_model.derivatives(rocket, y, liquid_throttle, srb_throttle, mass_flow)
+
+    # The first derivative is evaluated here so its atmosphere can be logged without a second lookup
+    state = rocket_model.get_state(rocket)
+    atmosphere = atmo.lookup(rocket.altitude)
+    k1 = rocket_model.derivatives(rocket, state, liquid_throttle, srb_throttle, mass_flow, atmosphere)
+    if rocket.recorder is not None:
+        rocket.recorder.record(rocket, throttle, atmosphere.density)
+
+    time_old = rocket.time
+    mass = rocket.mass
+    rocket.time, state, event, rocket.next_step, steps, evaluations = integrate(
+        derivative, rocket.time, state, rocket.time + duration, rocket_events(rocket, separation_time) + list(events),
+        relative_tolerance, absolute_tolerance, rocket.next_step, max_step, k1=k1)
+    evaluations += 1
+    rocket_model.set_state(rocket, state)
+
+    # Events are located just past the crossing, so the tank that caused one is drained completely here
+    rocket.mass = mass
+    rocket_model.drain_propellant(rocket, rocket.time - time_old)
+    rocket.step_count += steps
+
+    rocket.step_time += time.perf_counter() - start
+    return event.name if event is not None else None, evaluations
+
+
+def fueled_rocket():
+    """
+    :return: Returns the default vehicle on the pad with its core tanks full, as pre_launch() leaves it, pointing
+    straight up
+    """
+    rocket = rocket_model.load_rocket(hardware=False)
+    rocket.flight_path_angle = 90
+    rocket_model.fill_tanks(rocket)
+    return rocket
+
+
+def check(duration=100.0, delta_time=0.01, relative_tolerance=1e-9, event_altitude=20000.0):
+    """
+    This function is a regression check of the propagator. It flies the default vehicle straight up with adaptive
+    steps and with small fixed RK4 steps, which must agree. It then locates two events: SRB burnout, whose time is
+    known exactly because the SRBs burn at a fixed rate, and an altitude crossing. A vertical climb is used because
+    the gravity turn off the pad starts at MINIMUM_TURN_VELOCITY, where the equations have a kink that makes any two
+    integrators drift apart.
+    :param duration: Time to fly before the comparison in seconds, should end before SRB burnout
+    :param delta_time: RK4 step size in seconds
+    :param relative_tolerance: Tolerance of the adaptive flight, the absolute tolerances are scaled to match
+    :param event_altitude: Altitude of the crossing event in meters, reached before SRB burnout
+    :return: Returns the largest relative difference between the two states, the error of the located SRB burnout
+    time in seconds and how far from event_altitude the crossing was located in meters
+    """
+    reference = fueled_rocket()
+    for i in range(int(round(duration / delta_time))):
+        rocket_model.step(reference, delta_time)
+
+    adaptive = fueled_rocket()
+    propagate(adaptive, duration, relative_tolerance=relative_tolerance,
+              absolute_tolerance=ABSOLUTE_TOLERANCE * relative_tolerance / RELATIVE_TOLERANCE)
+    expected = rocket_model.get_state(reference)
+    difference = numpy.max(numpy.abs(rocket_model.get_state(adaptive) - expected) /
+                           numpy.maximum(numpy.abs(expected), 1))
+
+    staged = fueled_rocket()
+    burnout_time = staged.time + staged.stage.srb.mass / staged.stage.srb.FLOW_RATE_MAX
+    crossing = Event("altitude", lambda t, y: y[rocket_model.ALTITUDE] - event_altitude, 1)
+    for expected_event in ["altitude", "srb_burnout"]:
+        event, evaluations = propagate(staged, 2 * burnout_time, events=[crossing] if staged.time == 0 else [])
+        if event != expected_event:
+            raise RuntimeError('expected the ' + expected_event + ' event, got ' + str(event))
+        if event == "altitude":
+            altitude_error = abs(staged.altitude - event_altitude)
+    return difference, abs(staged.time - burnout_time), altitude_error
+
+
+def main():
+    difference, time_error, altitude_error = check()
+    print('Adaptive against RK4: {0:.3g} relative, SRB burnout located within {1:.3g} s, altitude crossing within '
+          '{2:.3g} m'.format(difference, time_error, altitude_error))
+    if difference > 1e-6 or time_error > 1e-6 or altitude_error > 1e-2:
+        raise SystemExit('propagator check failed')
+
+
+if __name__ == '__main__':
+    main()
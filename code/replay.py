@@ -0,0 +1,164 @@
+import time
+import numpy
+import telemetry
+
+SPEEDS = (1, 10, 100)  # Replay speeds offered on the panel
+FRAME_RATE = 20  # Default panel updates per second of wall time
+
+
+# -------------------OUTPUTS-------------------
+class PropellantOutput:
+    """
+    Shows a telemetry field on a console.PropellantDisplay.
+    """
+    def __init__(self, display, field='mass'):
+        self.display = display
+        self.field = field
+
+    def update(self, record):
+        self.display.display(int(record[self.field]))
+
+
+class SegmentOutput:
+    """
+    Shows a telemetry field on one 4 digit SevenSegmentDisplay, clamped to what fits.
+    """
+    def __init__(self, display, field, scale=1.0):
+        """
+        :param display: SevenSegmentDisplay to write to
+        :param field: Name of a telemetry.TELEMETRY_TYPE field
+        :param scale: Factor applied before display, e.g. 0.001 to show altitude in km
+        """
+        self.display = display
+        self.field = field
+        self.scale = scale
+
+    def update(self, record):
+        self.display.write_int(min(max(int(record[self.field] * self.scale), 0), 9999))
+
+
+class AlarmOutput:
+    """
+    Triggers an alarms.Alarm when condition(record) becomes True.
+    """
+    def __init__(self, alarm, condition):
+        self.alarm = alarm
+        self.condition = condition
+        self.active = False
+
+    def update(self, record):
+        active = bool(self.condition(record))
+        if active and not self.active:
+            self.alarm.trigger()
+        self.active = active
+        self.alarm.update()
+
+
+class AttitudeOutput:
+    """
+    Drives an attitude indicator. The indicator is any function taking the flight path angle in degrees.
+    """
+    def __init__(self, set_angle):
+        self.set_angle = set_angle
+
+    def update(self, record):
+        self.set_angle(float(record['flight_path_angle']))
+
+
+class Replay:
+    """
+    Plays a recorded flight back through the panel outputs without running the physics. Playback is paced by the
+    wall clock: each frame shows the latest record at or before the replayed mission time, so fast replays skip
+    records instead of falling behind. Records are found by binary search on the time column, so seeking to any
+    mission time is O(log n) even on logs that are never read into memory.
+    """
+    def __init__(self, log, outputs, speed=1, frame_rate=FRAME_RATE):
+        """
+        :param log: TELEMETRY_TYPE array or the name of a recorded .npy file
+        :param outputs: List of objects with an update(record) method, see the classes above
+        :param speed: Mission seconds replayed per wall second
+        :param frame_rate: Panel updates per wall second
+        """
+        if isinstance(log, str):
+            log = telemetry.load(log)
+        if len(log) == 0:
+            raise ValueError('the flight log is empty')
+        self.log = log
+        self.times = log['time']
+        self.outputs = outputs
+        self.speed = speed
+        self.frame_rate = frame_rate
+        self.index = 0  # Record shown last
+
+        # -------------------STATISTICS-------------------
+        self.frames = 0  # Panel updates done
+        self.skipped = 0  # Records passed over between frames
+        self.overruns = 0  # Frames whose output updates took longer than the frame period
+        self.output_time = 0.0  # Wall time spent in the outputs [s]
+
+    def find(self, mission_time):
+        """
+        :param mission_time: Mission time in seconds
+        :return: Returns the index of the latest record at or before mission_time, the first record if none is
+        """
+        return max(int(numpy.searchsorted(self.times, mission_time, side='right')) - 1, 0)
+
+    def seek(self, mission_time):
+        """
+        This function moves the replay to a mission time, the next play() starts there.
+        :param mission_time: Mission time in seconds
+        :return: Returns the index of the record the replay moved to
+        """
+        self.index = self.find(mission_time)
+        return self.index
+
+    def show(self, index):
+        """
+        This function sends one record to every output.
+        :param index: Index of the record
+        :return: Nothing is returned
+        """
+        start = time.perf_counter()
+        record = self.log[index]
+        for output in self.outputs:
+            output.update(record)
+        self.output_time += time.perf_counter() - start
+        self.frames += 1
+
+    def play(self, until=None):
+        """
+        This function replays from the current position in real time scaled by speed.
+        :param until: Mission time to stop at in seconds, the end of the log by default
+        :return: Returns the index of the last record shown
+        """
+        end = len(self.log) - 1 if until is None else self.find(until)
+        index = self.index
+        mission_start = float(self.times[index])
+        wall_start = time.monotonic()
+        period = 1.0 / self.frame_rate
+
+        self.show(index)
+        while index < end:
+            frame_start = time.monotonic()
+            mission_time = mission_start + (frame_start - wall_start) * self.speed
+            new_index = min(self.find(mission_time), end)
+            if new_index != index:
+                self.skipped += new_index - index - 1
+                index = new_index
+                self.show(index)
+            self.index = index
+
+            remaining = period - (time.monotonic() - frame_start)
+            if remaining > 0:
+                time.sleep(remaining)
+            else:
+                self.overruns += 1
+        return index
+
+    def frames_per_second(self):
+        """
+        :return: Returns how many panel updates per second the outputs managed, a measure of display throughput
+        """
+        if self.output_time == 0:
+            return 0
+        return self.frames / self.output_time
@@ -1,14 +1,16 @@
 from itertools import combinations
 import random
 import seven_segment_i2c
+import simulation_clock
+import display_service
 import Adafruit_GPIO as GPIO
-import time
 
 
 # ------------------------------------CONSTANTS----------------------------------
 RESISTOR_VALUES = [1000.0, 1100.0, 1300.0,
                    2000.0, 2100.0, 2300.0,
                    3000.0, 3300.0, 3500.0]  # Resistor values in Ohms
+SWITCH_POLL_PERIOD = 0.5  # Time between switch readings in seconds
 # Location of resistors:
 # 0 1 2 (parallel group 1)
 # 3 4 5 (parallel group 2)
@@ -104,9 +106,20 @@ def main():
 
     goal = int(set_goal(load_combinations()))
     print(goal)
-    goal_display.write_int(goal)
-
+    # The five displays share one bus, its worker spreads their writes over it so the switches keep being polled
+    # and the reading the player is watching is refreshed first
+    displays = display_service.DisplayService()
+    displays.register(goal_display, 'goal', priority=0, refresh_rate=2)
+    displays.register(actual_display, 'actual', priority=2, refresh_rate=10)
+    displays.register(parallel_group_display0, 'group 0', priority=1, refresh_rate=5)
+    displays.register(parallel_group_display1, 'group 1', priority=1, refresh_rate=5)
+    displays.register(parallel_group_display2, 'group 2', priority=1, refresh_rate=5)
+    displays.display(goal_display, goal)
+
+    clock = simulation_clock.SimulationClock(SWITCH_POLL_PERIOD)
     while True:
+        clock.tick()
+
         # Read all the switches.
         switch_states = [0] * len(switches)
         resistance = [0, 0, 0]
@@ -132,21 +145,21 @@ def main():
                 resistance[i] = int(1 / resistance[i])
             print(resistance)
             print(sum(resistance))
-            parallel_group_display0.write_int(resistance[0])
-            parallel_group_display1.write_int(resistance[1])
-            parallel_group_display2.write_int(resistance[2])
-            actual_display.write_int(sum(resistance))
+            displays.display(parallel_group_display0, resistance[0])
+            displays.display(parallel_group_display1, resistance[1])
+            displays.display(parallel_group_display2, resistance[2])
+            displays.display(actual_display, sum(resistance))
         else:
             # The circuit is NOT complete and we should print the open loop values to the displays
-            actual_display.write_int(open_loop_val)
-            parallel_group_display0.write_int(open_loop_val)
-            parallel_group_display1.write_int(open_loop_val)
-            parallel_group_display2.write_int(open_loop_val)
+            displays.display(actual_display, open_loop_val)
+            displays.display(parallel_group_display0, open_loop_val)
+            displays.display(parallel_group_display1, open_loop_val)
+            displays.display(parallel_group_display2, open_loop_val)
 
         # Print the ADC values.
         # print('| {0:>1} | {1:>1} | {2:>1} | {3:>6} | {4:>1} | {5:<6} | {6:>1} | {7:>1} | {8:>1} |'.format(*switch_states))
-        # Pause for half a second.
-        time.sleep(0.5)
+        # Wait for the next poll, the period holds however long the display writes took
+        clock.wait()
 
 if __name__ == '__main__':
     main()
@@ -4,24 +4,79 @@ import numpy
 import math
 # from scipy.optimize import fsolve
 import atmospheric_model as atmo
+import vehicle
 import touch_pot
 import console
+import display_service
+import simulation_clock
 from random import randint
 
 EARTH_RADIUS = 6.371 * 10 ** 6  # Radius of Earth in meters
+MINIMUM_TURN_VELOCITY = 1.0  # Below this speed [m/s] the flight path angle is held constant to avoid dividing by zero
+MINIMUM_IMPLICIT_STEP = 1e-3  # Shortest step implicit_step() splits a step into before giving up [s]
+ENGINE_TABLE_SIZE = 33  # Number of ambient pressures in each stage's thrust/ISP table
+NO_DEPLETION = ()  # Returned by drain_propellant() when no tank ran dry
+PRE_LAUNCH_STEP = 0.005  # Time between propellant top-ups while filling the tanks [s]
+PRE_LAUNCH_FRAME_RATE = 20  # Tank display updates per second while filling the tanks
+
+# Indices into the flat state vector used by the integrators
+ALTITUDE = 0  # [m]
+VELOCITY = 1  # [m/s]
+FLIGHT_PATH_ANGLE = 2  # [rad]
+MASS = 3  # [kg]
 
 
 class Rocket:
+    # A fixed schema keeps attribute access fast and instances small, and turns attribute typos into errors
+    __slots__ = ['flight_path_angle', 'altitude', 'velocity', 'mass', 'current_stage', 'stage', 'time', 'next_step',
+                 'step_count', 'step_time', 'newton_iterations', 'implicit_increment',
+                 'stage1', 'stage2', 'stage3', 'stage4', 'stages', 'throttle', 'recorder']
+
     def __init__(self):
         # -------------------VARIABLES-------------------
         self.flight_path_angle = 0  # [degrees]
         self.altitude = 0  # [m]
         self.velocity = 0  # [m/s]
+        self.mass = 0  # [kg]
+        self.current_stage = ""  # Name of the active stage
+        self.stage = None  # The active Stage object, resolved once per staging so the physics never looks it up
+        self.time = 0  # Mission elapsed time [s]
+        self.next_step = 1.0  # Step size suggested by the adaptive integrator [s]
+
+        # -------------------PERFORMANCE-------------------
+        self.step_count = 0  # Number of integrator steps taken
+        self.step_time = 0  # Wall time spent inside the integrator [s]
+        self.newton_iterations = 0  # Total Newton iterations taken by the implicit integrator
+        self.implicit_increment = numpy.zeros(3)  # Rate of change from the last implicit step, used as a warm start
+
+        # -------------------COMPONENTS-------------------
+        self.stage1 = None
+        self.stage2 = None
+        self.stage3 = None
+        self.stage4 = None
+        self.stages = []  # Names of the stages in firing order
+        self.throttle = None
+        self.recorder = None  # telemetry.FlightRecorder every step is logged to, None to record nothing
+
+    def validate(self):
+        """
+        Checks every stage in the rocket, raising ValueError on the first bad value.
+        """
+        for name in self.stages:
+            stage = getattr(self, name)
+            if not isinstance(stage, Stage):
+                raise ValueError(name + ' is not a Stage')
+            stage.validate(name)
 
 
 class Stage:
+    __slots__ = ['THRUST_SEA', 'THRUST_VAC', 'ISP_SEA', 'ISP_VAC', 'MIXTURE', 'PROPELLANT_MASS', 'DEAD_MASS',
+                 'PAYLOAD_MASS', 'DIAMETER', 'AREA', 'DRAG_COEFFICIENT', 'SRB_THRUST_SEA', 'SRB_THRUST_VAC',
+                 'SRB_ISP_SEA', 'SRB_ISP_VAC', 'fuel', 'oxidizer', 'srb', 'total_mass', 'engine', 'srb_engine']
+
     def __init__(self):
         # -------------------CONSTANTS-------------------
+        # Liquid engines
         self.THRUST_SEA = 0  # [N]
         self.THRUST_VAC = 0  # [N]
 
@@ -34,9 +89,55 @@ class Stage:
         self.DEAD_MASS = 0  # [kg]
         self.PAYLOAD_MASS = 0  # [kg]
 
+        self.DIAMETER = 0  # [m]
+        self.AREA = 0  # [m^2]
+        self.DRAG_COEFFICIENT = 0  # [ ]
+
+        # Solid rocket boosters, all of them together
+        self.SRB_THRUST_SEA = 0  # [N]
+        self.SRB_THRUST_VAC = 0  # [N]
+        self.SRB_ISP_SEA = 0  # [s]
+        self.SRB_ISP_VAC = 0  # [s]
+
+        # -------------------COMPONENTS-------------------
+        self.fuel = None
+        self.oxidizer = None
+        self.srb = None  # Only stages with solid rocket boosters have one
+
+        # -------------------VARIABLES-------------------
+        self.total_mass = 0  # [kg]
+        self.engine = None  # EngineTable of the liquid engines, built from the constants above by build_rocket
+        self.srb_engine = None  # EngineTable of the SRBs, None if the stage has none
+
+    def validate(self, name="stage"):
+        """
+        Checks that every constant is a non-negative number and every tank is a valid Propellant.
+        :param name: Name used in error messages
+        """
+        for field in ['THRUST_SEA', 'THRUST_VAC', 'ISP_SEA', 'ISP_VAC', 'MIXTURE', 'PROPELLANT_MASS', 'DEAD_MASS',
+                      'PAYLOAD_MASS', 'DIAMETER', 'AREA', 'DRAG_COEFFICIENT', 'SRB_THRUST_SEA', 'SRB_THRUST_VAC',
+                      'SRB_ISP_SEA', 'SRB_ISP_VAC', 'total_mass']:
+            _check_non_negative(name + '.' + field, getattr(self, field))
+        for prefix in ['', 'SRB_']:
+            if getattr(self, prefix + 'THRUST_VAC') > 0 and getattr(self, prefix + 'ISP_VAC') <= 0:
+                raise ValueError(name + ' has ' + prefix + 'vacuum thrust but no vacuum specific impulse')
+            if getattr(self, prefix + 'THRUST_SEA') > 0 and getattr(self, prefix + 'ISP_SEA') <= 0:
+                raise ValueError(name + ' has ' + prefix + 'sea-level thrust but no sea-level specific impulse')
+        if self.srb is not None and self.SRB_THRUST_SEA <= 0 and self.SRB_THRUST_VAC <= 0:
+            raise ValueError(name + ' has an srb tank but no SRB thrust')
+        for field in ['fuel', 'oxidizer', 'srb']:
+            tank = getattr(self, field)
+            if tank is None:
+                continue
+            if not isinstance(tank, Propellant):
+                raise ValueError(name + '.' + field + ' is not a Propellant')
+            tank.validate(name + '.' + field)
+
 
 class Propellant:
     # This is a class for the fuels and oxidizers
+    __slots__ = ['MASS_MAX', 'PRESSURE_RANGE', 'FLOW_RATE_MAX', 'NAME', 'mass', 'pressure', 'flow_rate']
+
     def __init__(self):
         # -------------------CONSTANTS-------------------
         self.MASS_MAX = 0  # [kg]
@@ -49,171 +150,140 @@ class Propellant:
         self.pressure = 0  # [kg]
         self.flow_rate = 0  # [kg/s]
 
+    def validate(self, name="propellant"):
+        """
+        Checks that the tank limits are non-negative and the current mass is within them.
+        :param name: Name used in error messages
+        """
+        for field in ['MASS_MAX', 'FLOW_RATE_MAX', 'mass', 'pressure', 'flow_rate']:
+            _check_non_negative(name + '.' + field, getattr(self, field))
+        if self.mass > self.MASS_MAX:
+            raise ValueError(name + '.mass ' + str(self.mass) + ' exceeds MASS_MAX ' + str(self.MASS_MAX))
+        if len(self.PRESSURE_RANGE) != 2 or self.PRESSURE_RANGE[0] > self.PRESSURE_RANGE[1]:
+            raise ValueError(name + '.PRESSURE_RANGE must be [low, high]')
 
-def load_rocket():
+
+class EngineTable:
+    """
+    Thrust and specific impulse of one set of engines as a function of ambient pressure. Nozzle thrust falls
+    linearly with ambient pressure, T = T_vac - (T_vac - T_sea) * p / p_sea, and ISP follows the same line. The curve
+    is sampled once into a small table so the physics does one lookup per evaluation, with no branch or
+    discontinuity at a fixed altitude. Engines without sea-level values are treated as vacuum engines with constant
+    performance. A stage with SRBs has one table for its liquid engines and one for the SRBs, since the two burn out
+    at different times.
     """
-    This function creates a rocket object including stages and propellants. The rocket is modeled after NASA's SLS B1
+    __slots__ = ['thrust', 'isp', 'scale', 'last']
+
+    def __init__(self, thrust_vac, isp_vac, thrust_sea=0, isp_sea=0, size=ENGINE_TABLE_SIZE):
+        """
+        :param thrust_vac: Full throttle thrust in vacuum in Newtons
+        :param isp_vac: Specific impulse in vacuum in seconds
+        :param thrust_sea: Full throttle thrust at sea level in Newtons, 0 for a vacuum engine
+        :param isp_sea: Specific impulse at sea level in seconds, 0 for a vacuum engine
+        :param size: Number of ambient pressures in the table
+        """
+        sea_level_pressure = atmo.pressure(0)
+        pressures = numpy.linspace(0, sea_level_pressure, size)
+        if thrust_sea <= 0:
+            thrust_sea = thrust_vac
+        if isp_sea <= 0:
+            isp_sea = isp_vac
+        if thrust_vac <= 0:
+            thrust_vac = thrust_sea
+        if isp_vac <= 0:
+            isp_vac = isp_sea
+
+        self.thrust = numpy.interp(pressures, [0, sea_level_pressure], [thrust_vac, thrust_sea])  # [N]
+        self.isp = numpy.interp(pressures, [0, sea_level_pressure], [isp_vac, isp_sea])  # [s]
+        self.scale = (size - 1) / sea_level_pressure  # Table rows per kPa
+        self.last = size - 1
+
+    def lookup(self, pressure):
+        """
+        :param pressure: Ambient pressure in kPa
+        :return: Returns the full throttle thrust in Newtons and the specific impulse in seconds
+        """
+        position = pressure * self.scale
+        if position >= self.last:
+            return float(self.thrust[self.last]), float(self.isp[self.last])
+        if position <= 0:
+            return float(self.thrust[0]), float(self.isp[0])
+        index = int(position)
+        fraction = position - index
+        thrust_low = self.thrust[index]
+        isp_low = self.isp[index]
+        return (float(thrust_low + fraction * (self.thrust[index + 1] - thrust_low)),
+                float(isp_low + fraction * (self.isp[index + 1] - isp_low)))
+
+    def lookup_array(self, pressure):
+        """
+        :param pressure: Array of ambient pressures in kPa
+        :return: Returns arrays of full throttle thrust in Newtons and specific impulse in seconds
+        """
+        position = numpy.clip(numpy.asarray(pressure, dtype=float) * self.scale, 0, self.last)
+        index = numpy.minimum(position.astype(int), self.last - 1)
+        fraction = position - index
+        return (self.thrust[index] + fraction * (self.thrust[index + 1] - self.thrust[index]),
+                self.isp[index] + fraction * (self.isp[index + 1] - self.isp[index]))
+
+
+def _check_non_negative(name, value):
+    """
+    Raises ValueError unless value is a finite, non-negative number.
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float, numpy.number)) or not value >= 0 \
+            or math.isinf(value):
+        raise ValueError(name + ' must be a non-negative number, got ' + repr(value))
+
+
+def load_rocket(hardware=True, definition_file=vehicle.DEFAULT_VEHICLE):
+    """
+    This function creates a rocket object including stages and propellants. By default the rocket is modeled after
+    NASA's SLS B1, see vehicles/sls_block1.json.
+    :param hardware: If False the touch pot throttle is not opened, for simulations run away from the cockpit. If True
+    the touch pot is polled by a background ThrottleSampler so the physics never waits on the I2C bus.
+    :param definition_file: JSON or TOML vehicle definition to load
     :return: Returns a rocket object loaded with stages and propellants.
     """
-    # ---------------------ROCKET-INITIATION---------------------
-    # NASA's Space Launch System
+    rocket = build_rocket(vehicle.load(definition_file))
+    if hardware:
+        rocket.throttle = touch_pot.ThrottleSampler(touch_pot.TouchPot(1, 0x08)).start()
+    return rocket
+
+
+def build_rocket(definition):
+    """
+    This function creates a rocket object from a compiled vehicle definition.
+    :param definition: vehicle.VehicleDefinition
+    :return: Returns a rocket object loaded with stages and propellants, sitting on the pad with the first stage active.
+    """
     rocket = Rocket()
-    rocket.flight_path_angle = 89.95  # [degrees]
-    rocket.altitude = 0  # [m]
-    rocket.velocity = 0  # [m/s]
-    rocket.current_stage = "stage1"
-
-    # ---------------------STAGE-4-INITIATION---------------------
-    # Orion capsule and service module with AJ10 engine
-    rocket.stage4 = Stage()
-    rocket.stage4.THRUST_VAC = 25700  # [N]
-    rocket.stage4.ISP_VAC = 319  # [s]
-    rocket.stage4.MIXTURE = 1.9  # [ ]
-    rocket.stage4.PROPELLANT_MASS = 9276  # [kg]
-    rocket.stage4.DEAD_MASS = 6185  # [kg]
-    rocket.stage4.PAYLOAD_MASS = 10387  # [kg]
-    rocket.stage4.DIAMETER = 5.03  # [m]
-    rocket.stage4.AREA = 3.14 * rocket.stage4.DIAMETER ** 2
-    rocket.stage4.DRAG_COEFFICIENT = 0.5  # Assuming a constant drag coefficient
-
-    rocket.stage4.fuel = Propellant()
-    rocket.stage4.fuel.NAME = "MMH"
-    rocket.stage4.fuel.MASS_MAX = int(rocket.stage4.PROPELLANT_MASS / (rocket.stage4.MIXTURE + 1))  # [kg]
-    rocket.stage4.fuel.PRESSURE_RANGE = [1613000, 1958000]  # [Pa]
-    rocket.stage4.fuel.FLOW_RATE_MAX = rocket.stage4.THRUST_VAC / rocket.stage4.ISP_VAC / (
-        rocket.stage4.MIXTURE + 1)  # [kg/s]
-    rocket.stage4.fuel.mass = rocket.stage4.fuel.MASS_MAX  # [kg]
-    rocket.stage4.fuel.pressure = numpy.mean(rocket.stage4.fuel.PRESSURE_RANGE)  # [Pa]
-
-    rocket.stage4.oxidizer = Propellant()
-    rocket.stage4.oxidizer.NAME = "MON"
-    rocket.stage4.oxidizer.MASS_MAX = int(rocket.stage4.PROPELLANT_MASS * rocket.stage4.MIXTURE / (
-        rocket.stage4.MIXTURE + 1))  # [kg]
-    rocket.stage4.oxidizer.PRESSURE_RANGE = [1613000, 1958000]  # [Pa]
-    rocket.stage4.oxidizer.FLOW_RATE_MAX = int(rocket.stage4.THRUST_VAC / rocket.stage4.ISP_VAC * rocket.stage4.MIXTURE / (
-        rocket.stage4.MIXTURE + 1))  # [kg/s]
-    rocket.stage4.oxidizer.mass = rocket.stage4.oxidizer.MASS_MAX  # [kg]
-    rocket.stage4.oxidizer.pressure = numpy.mean(rocket.stage4.oxidizer.PRESSURE_RANGE)  # [Pa]
-
-    rocket.stage4.total_mass = rocket.stage4.DEAD_MASS + rocket.stage4.PROPELLANT_MASS + rocket.stage4.PAYLOAD_MASS
-
-    # ---------------------STAGE-3-INITIATION---------------------
-    # Exploration stage with 4 RL10 engines
-
-    rocket.stage3 = Stage()
-    rocket.stage3.THRUST_VAC = 440000  # [N]
-    rocket.stage3.ISP_VAC = 450  # [s]
-    rocket.stage3.MIXTURE = 5.5  # [ ]
-    rocket.stage3.PROPELLANT_MASS = 129000  # [kg]
-    rocket.stage3.DEAD_MASS = int((rocket.stage3.PROPELLANT_MASS + 4 * 277) * 1.1)  # [kg] (an approx 277 = engine mass)
-    rocket.stage3.PAYLOAD_MASS = rocket.stage4.DEAD_MASS + rocket.stage4.PAYLOAD_MASS + rocket.stage4.PROPELLANT_MASS
-    # [kg]
-    rocket.stage3.DIAMETER = 8.4  # [m]
-    rocket.stage3.AREA = 3.14 * rocket.stage3.DIAMETER ** 2
-    rocket.stage3.DRAG_COEFFICIENT = 0.5  # Assuming a constant drag coefficient
-
-    rocket.stage3.fuel = Propellant()
-    rocket.stage3.fuel.NAME = "LH2"
-    rocket.stage3.fuel.MAS_MAX = int(rocket.stage3.PROPELLANT_MASS / (rocket.stage3.MIXTURE + 1))  # [kg]
-    rocket.stage3.fuel.PRESSURE_RANGE = [220000, 230000]  # [Pa]
-    rocket.stage3.fuel.FLOW_RATE_MAX = int(rocket.stage3.THRUST_VAC / rocket.stage3.ISP_VAC / (
-        rocket.stage3.MIXTURE + 1))  # [kg/s]
-    rocket.stage3.fuel.mass = rocket.stage3.fuel.MASS_MAX  # [kg]
-    rocket.stage3.fuel.pressure = numpy.mean(rocket.stage3.fuel.PRESSURE_RANGE)  # [Pa]
-
-    rocket.stage3.oxidizer = Propellant()
-    rocket.stage3.oxidizer.NAME = "LOX"
-    rocket.stage3.oxidizer.MASS_MAX = int(rocket.stage3.PROPELLANT_MASS * rocket.stage3.MIXTURE / (
-        rocket.stage3.MIXTURE + 1))  # [kg]
-    rocket.stage3.oxidizer.PRESSURE_RANGE = [140000, 150000]  # [Pa]
-    rocket.stage3.oxidizer.FLOW_RATE_MAX = int(rocket.stage3.THRUST_VAC / rocket.stage3.ISP_VAC * rocket.stage3.MIXTURE / (
-        rocket.stage3.MIXTURE + 1))  # [kg/s]
-    rocket.stage3.oxidizer.mass = rocket.stage3.oxidizer.MASS_MAX  # [kg]
-    rocket.stage3.oxidizer.pressure = numpy.mean(rocket.stage3.oxidizer.PRESSURE_RANGE)  # [Pa]
-
-    rocket.stage3.total_mass = rocket.stage3.DEAD_MASS + rocket.stage3.PROPELLANT_MASS + rocket.stage3.PAYLOAD_MASS
-
-    # ---------------------STAGE-2-INITIATION---------------------
-    # Core stage with 4 RS-25 engines
-    rocket.stage2 = Stage()
-    rocket.stage2.THRUST_SEA = 4 * 1860000  # [N]
-    rocket.stage2.THRUST_VAC = 4 * 2279000  # [N]
-    rocket.stage2.ISP_SEA = 366  # [s]
-    rocket.stage2.ISP_VAC = 452.3  # [s]
-    rocket.stage2.MIXTURE = 6.0  # [ ]
-    rocket.stage2.PROPELLANT_MASS = 894182  # [kg]
-    rocket.stage2.DEAD_MASS = 85270  # [kg]
-    rocket.stage2.PAYLOAD_MASS = rocket.stage3.DEAD_MASS + rocket.stage3.PAYLOAD_MASS + rocket.stage3.PROPELLANT_MASS
-    # [kg]
-    rocket.stage2.DIAMETER = 8.4  # [m]
-    rocket.stage2.AREA = 3.14 * rocket.stage2.DIAMETER ** 2
-    rocket.stage2.DRAG_COEFFICIENT = 0.5  # Assuming a constant drag coefficient
-
-    rocket.stage2.fuel = Propellant()
-    rocket.stage2.fuel.NAME = "LH2"
-    rocket.stage2.fuel.MASS_MAX = int(rocket.stage2.PROPELLANT_MASS / (rocket.stage2.MIXTURE + 1))  # [kg]
-    rocket.stage2.fuel.PRESSURE_RANGE = [220000, 230000]  # [Pa]
-    rocket.stage2.fuel.FLOW_RATE_MAX = int(rocket.stage2.THRUST_SEA / rocket.stage2.ISP_SEA / (
-        rocket.stage2.MIXTURE + 1))  # [kg/s]
-    rocket.stage2.fuel.mass = rocket.stage2.fuel.MASS_MAX  # [kg]
-    rocket.stage2.fuel.pressure = numpy.mean(rocket.stage2.fuel.PRESSURE_RANGE)  # [Pa]
-
-    rocket.stage2.oxidizer = Propellant()
-    rocket.stage2.oxidizer.NAME = "LOX"
-    rocket.stage2.oxidizer.MASS_MAX = int(rocket.stage2.PROPELLANT_MASS * rocket.stage2.MIXTURE / (
-        rocket.stage2.MIXTURE + 1))  # [kg]
-    rocket.stage2.oxidizer.PRESSURE_RANGE = [140000, 150000]  # [Pa]
-    rocket.stage2.oxidizer.FLOW_RATE_MAX = int(rocket.stage2.THRUST_SEA / rocket.stage2.ISP_SEA * rocket.stage2.MIXTURE / (
-        rocket.stage2.MIXTURE + 1))  # [kg/s]
-    rocket.stage2.oxidizer.mass = rocket.stage2.oxidizer.MASS_MAX  # [kg]
-    rocket.stage2.oxidizer.pressure = numpy.mean(rocket.stage2.oxidizer.PRESSURE_RANGE)  # [Pa]
-
-    rocket.stage2.total_mass = rocket.stage2.DEAD_MASS + rocket.stage2.PROPELLANT_MASS + rocket.stage2.PAYLOAD_MASS
-
-    # ---------------------STAGE-1-INITIATION---------------------
-    # Core stage with 4 RS-25 engines and 2 5-segment SRBs
-    rocket.stage1 = Stage()
-    rocket.stage1.THRUST_SEA = 32000000 + rocket.stage2.THRUST_SEA  # [N]
-    rocket.stage1.THRUST_VAC = rocket.stage2.THRUST_VAC  # [N]
-    rocket.stage1.ISP_SEA = 269  # [s]
-    rocket.stage1.ISP_VAC = rocket.stage2.ISP_VAC  # [s]
-    rocket.stage1.MIXTURE = 6.0  # [ ]
-    rocket.stage1.PROPELLANT_MASS = 894182  # [kg]
-    rocket.stage1.DEAD_MASS = 227500  # [kg]
-    rocket.stage1.PAYLOAD_MASS = rocket.stage3.total_mass
-    # [kg]
-    rocket.stage1.DIAMETER = 9.9  # [m]
-    rocket.stage1.AREA = 3.14 * rocket.stage1.DIAMETER ** 2
-    rocket.stage1.DRAG_COEFFICIENT = 0.5  # Assuming a constant drag coefficient
-
-    rocket.stage1.fuel = Propellant()
-    rocket.stage1.fuel.NAME = "LH2"
-    rocket.stage1.fuel.MASS_MAX = rocket.stage2.fuel.MASS_MAX  # [kg]
-    rocket.stage1.fuel.PRESSURE_RANGE = rocket.stage2.fuel.PRESSURE_RANGE  # [Pa]
-    rocket.stage1.fuel.FLOW_RATE_MAX = rocket.stage2.fuel.FLOW_RATE_MAX  # [kg/s]
-    rocket.stage1.fuel.mass = 0  # [kg]
-    rocket.stage1.fuel.pressure = 0  # [Pa]
-
-    rocket.stage1.oxidizer = Propellant()
-    rocket.stage1.oxidizer.NAME = "LOX"
-    rocket.stage1.oxidizer.MASS_MAX = rocket.stage2.oxidizer.MASS_MAX  # [kg]
-    rocket.stage1.oxidizer.PRESSURE_RANGE = rocket.stage2.oxidizer.PRESSURE_RANGE  # [Pa]
-    rocket.stage1.oxidizer.FLOW_RATE_MAX = rocket.stage2.oxidizer.FLOW_RATE_MAX  # [kg/s]
-    rocket.stage1.oxidizer.mass = 0  # [kg]
-    rocket.stage1.oxidizer.pressure = 0  # [Pa]
-
-    rocket.stage1.srb = Propellant()
-    rocket.stage1.srb.NAME = "srb"
-    rocket.stage1.srb.MASS_MAX = 1250000  # [kg]
-    rocket.stage1.srb.FLOW_RATE_MAX = int(rocket.stage1.THRUST_SEA / rocket.stage1.ISP_SEA)  # [kg/s]
-    rocket.stage1.srb.mass = rocket.stage1.srb.MASS_MAX  # [kg]
-
-    rocket.stage1.total_mass = rocket.stage1.DEAD_MASS + rocket.stage1.PAYLOAD_MASS + rocket.stage1.PROPELLANT_MASS
+    rocket.flight_path_angle = definition.FLIGHT_PATH_ANGLE  # [degrees]
+
+    for stage_definition in definition.stages:
+        stage = Stage()
+        for field in vehicle.StageDefinition._fields:
+            if field not in Stage.__slots__:
+                continue
+            value = getattr(stage_definition, field)
+            if isinstance(value, vehicle.PropellantDefinition):
+                propellant = Propellant()
+                for propellant_field in Propellant.__slots__:
+                    setattr(propellant, propellant_field, getattr(value, propellant_field))
+                propellant.PRESSURE_RANGE = list(value.PRESSURE_RANGE)
+                value = propellant
+            setattr(stage, field, value)
+        stage.engine = EngineTable(stage.THRUST_VAC, stage.ISP_VAC, stage.THRUST_SEA, stage.ISP_SEA)
+        if stage.srb is not None:
+            stage.srb_engine = EngineTable(stage.SRB_THRUST_VAC, stage.SRB_ISP_VAC, stage.SRB_THRUST_SEA,
+                                           stage.SRB_ISP_SEA)
+        setattr(rocket, stage_definition.NAME, stage)
 
     # Build a list containing all the stages in the rocket
-    rocket.stages = [a for a in dir(rocket) if a.startswith('stage')]
-
-    rocket.throttle = touch_pot.TouchPot(1, 0x08)
+    rocket.stages = [stage_definition.NAME for stage_definition in definition.stages]
+    rocket.validate()
+    set_stage(rocket, rocket.stages[0])
+    rocket.mass = vehicle_mass(rocket)  # [kg]
 
     return rocket
 
@@ -228,39 +298,190 @@ def pre_launch(rocket):
     # Create the displays for the fuel and oxidizer, this should be moved elsewhere and imported as an object
     # fuel_display = console.PropellantDisplay(0x04, 0x05)
     oxidizer_display = console.PropellantDisplay(0x70, 0x71)
+    # Display writes go through a background worker so a slow or failing display never stalls the filling
+    displays = display_service.DisplayService()
+    # displays.register(fuel_display, 'fuel', refresh_rate=PRE_LAUNCH_FRAME_RATE)
+    displays.register(oxidizer_display, 'oxidizer', refresh_rate=PRE_LAUNCH_FRAME_RATE)
 
-    # The oxidizer always has a larger mass than the fuel so we will fill until the oxidizer is full
-    while rocket.stage1.oxidizer.mass < rocket.stage1.oxidizer.MASS_MAX:
-        rocket.stage1.oxidizer.mass += randint(175, 200)  # Add a random amount of oxidizer to the tank
-        rocket.stage1.fuel.mass += randint(175, 200)  # Add a random amount of fuel to the tank
+    # Filling is paced by a fixed step clock so it takes the same time however fast the displays are
+    clock = simulation_clock.SimulationClock(PRE_LAUNCH_STEP, frame_rate=PRE_LAUNCH_FRAME_RATE)
+    oxidizer = rocket.stage1.oxidizer
+    previous_mass = oxidizer.mass
 
-        # Check that we didn't over fill the tanks and set them to full if we do.
-        if rocket.stage1.oxidizer.mass > rocket.stage1.oxidizer.MASS_MAX:
-            rocket.stage1.oxidizer.mass = rocket.stage1.oxidizer.MASS_MAX
-        if rocket.stage1.fuel.mass > rocket.stage1.fuel.MASS_MAX:
-            rocket.stage1.fuel.mass = rocket.stage1.fuel.MASS_MAX
+    # The oxidizer always has a larger mass than the fuel so we will fill until the oxidizer is full
+    while oxidizer.mass < oxidizer.MASS_MAX:
+        for i in range(clock.tick()):
+            previous_mass = oxidizer.mass
+            oxidizer.mass += randint(175, 200)  # Add a random amount of oxidizer to the tank
+            rocket.stage1.fuel.mass += randint(175, 200)  # Add a random amount of fuel to the tank
+
+            # Check that we didn't over fill the tanks and set them to full if we do.
+            if oxidizer.mass > oxidizer.MASS_MAX:
+                oxidizer.mass = oxidizer.MASS_MAX
+            if rocket.stage1.fuel.mass > rocket.stage1.fuel.MASS_MAX:
+                rocket.stage1.fuel.mass = rocket.stage1.fuel.MASS_MAX
 
         # Display the oxidizer and fuel masses
-        oxidizer_display.display(rocket.stage1.oxidizer.mass)
-        # fuel_display.display(rocket.stage1.fuel.mass)
+        displays.display(oxidizer_display, int(clock.interpolate(previous_mass, oxidizer.mass)))
+        # displays.display(fuel_display, rocket.stage1.fuel.mass)
+        clock.wait()
+    displays.display(oxidizer_display, oxidizer.mass)
+    displays.stop()
+
+    # The tanks changed outside of flight, so the running mass has to be rebuilt
+    rocket.mass = vehicle_mass(rocket)
 
 
-def update(rocket):
+def fill_tanks(rocket):
     """
-    This function updates the rocket's altitude, velocity and flight path angle (fpa).
-    We take the previous values of altitude, velocity and fpa and use them along with a delta t as inputs for a root
-    solving function to find new values of altitude, velocity and fpa.
+    This function fills the tanks at once, leaving the rocket as pre_launch() does but without the displays. It is
+    meant for simulations that start on the pad.
     :param rocket: An input rocket containing stage classes and fuel sub-classes.
-    :return: Returns the rocket object with updated altitude, velocity and fpa
+    :return: Nothing is returned
     """
+    for tank in (rocket.stage1.fuel, rocket.stage1.oxidizer):
+        tank.mass = tank.MASS_MAX
+    rocket.mass = vehicle_mass(rocket)
 
 
-def functions(rocket, variables, delta_time):
+def update(rocket, delta_time):
+    """
+    This function updates the rocket's altitude, velocity, flight path angle (fpa) and mass.
+    We take the previous values of altitude, velocity, fpa and mass and advance them by delta t with an explicit
+    fourth order Runge-Kutta step, so no root solve is needed on each tick.
+    :param rocket: An input rocket containing stage classes and fuel sub-classes.
+    :param delta_time: Time step in seconds
+    :return: Returns the rocket object with updated altitude, velocity, fpa and mass
+    """
+    step(rocket, delta_time)
+    return rocket
+
+
+def get_state(rocket):
+    """
+    This function packs the rocket's variables into a flat state vector.
+    :param rocket: An input rocket containing stage classes and fuel sub-classes.
+    :return: Returns numpy array [altitude, velocity, flight path angle in radians, mass]
+    """
+    return numpy.array([rocket.altitude, rocket.velocity, math.radians(rocket.flight_path_angle), rocket.mass],
+                       dtype=float)
+
+
+def set_state(rocket, state):
+    """
+    This function unpacks a flat state vector into the rocket's variables.
+    :param rocket: An input rocket containing stage classes and fuel sub-classes.
+    :param state: numpy array [altitude, velocity, flight path angle in radians, mass]
+    :return: Nothing is returned
+    """
+    rocket.altitude = float(state[ALTITUDE])
+    rocket.velocity = float(state[VELOCITY])
+    rocket.flight_path_angle = math.degrees(state[FLIGHT_PATH_ANGLE])
+    rocket.mass = float(state[MASS])
+
+
+def derivatives(rocket, state, liquid_throttle, srb_throttle, mass_flow, atmosphere=None):
+    """
+    This function defines the equations of motion as time derivatives of the state vector. These are the same physics
+    as the residuals in functions(), written in explicit form. Thrust follows the ambient pressure.
+    :param rocket: An input rocket containing stage classes and fuel sub-classes.
+    :param state: numpy array [altitude, velocity, flight path angle in radians, mass]
+    :param liquid_throttle: Fraction of full thrust the liquid engines produce, see set_propellant_flow()
+    :param srb_throttle: Fraction of full thrust the SRBs produce, see set_propellant_flow()
+    :param mass_flow: Propellant mass flow in kg/s, see set_propellant_flow()
+    :param atmosphere: AtmosphereState at the state's altitude if the caller already looked it up
+    :return: Returns numpy array of d(state)/dt
+    """
+    altitude = state[ALTITUDE]
+    velocity = state[VELOCITY]
+    flight_path_angle = state[FLIGHT_PATH_ANGLE]
+    mass = state[MASS]
+
+    if atmosphere is None:
+        atmosphere = atmo.lookup(altitude)
+    sin_fpa = math.sin(flight_path_angle)
+    cos_fpa = math.cos(flight_path_angle)
+
+    thrust_force = stage_thrust(rocket.stage, atmosphere.pressure, liquid_throttle, srb_throttle)
+    drag = 0.5 * atmosphere.density * velocity ** 2 * rocket.stage.AREA * rocket.stage.DRAG_COEFFICIENT
+
+    d_state = numpy.empty(4)
+    d_state[ALTITUDE] = velocity * sin_fpa
+    d_state[VELOCITY] = (thrust_force - drag) / mass - atmosphere.gravity * sin_fpa
+    if velocity > MINIMUM_TURN_VELOCITY:
+        d_state[FLIGHT_PATH_ANGLE] = -(atmosphere.gravity - velocity ** 2 / (EARTH_RADIUS + altitude)) * cos_fpa / \
+            velocity
+    else:
+        d_state[FLIGHT_PATH_ANGLE] = 0
+    d_state[MASS] = -mass_flow
+    return d_state
+
+
+def rk4_step(rocket, state, delta_time, liquid_throttle, srb_throttle, mass_flow, atmosphere=None):
+    """
+    This function advances a state vector by one classic fourth order Runge-Kutta step.
+    :param rocket: An input rocket containing stage classes and fuel sub-classes.
+    :param state: numpy array [altitude, velocity, flight path angle in radians, mass]
+    :param delta_time: Time step in seconds
+    :param liquid_throttle: Fraction of full thrust of the liquid engines, held constant over the step
+    :param srb_throttle: Fraction of full thrust of the SRBs, held constant over the step
+    :param mass_flow: Propellant mass flow in kg/s, held constant over the step
+    :param atmosphere: AtmosphereState at the start of the step if the caller already looked it up
+    :return: Returns the new state vector
+    """
+    k1 = derivatives(rocket, state, liquid_throttle, srb_throttle, mass_flow, atmosphere)
+    k2 = derivatives(rocket, state + 0.5 * delta_time * k1, liquid_throttle, srb_throttle, mass_flow)
+    k3 = derivatives(rocket, state + 0.5 * delta_time * k2, liquid_throttle, srb_throttle, mass_flow)
+    k4 = derivatives(rocket, state + delta_time * k3, liquid_throttle, srb_throttle, mass_flow)
+    return state + delta_time / 6.0 * (k1 + 2 * k2 + 2 * k3 + k4)
+
+
+def step(rocket, delta_time):
+    """
+    This function advances the rocket by one fixed time step. The throttle is sampled once per step and the tanks
+    are drained by the flow it sets. If the rocket has a recorder, the state at the start of the step is logged with
+    the throttle and the atmosphere the step already used.
+    :param rocket: An input rocket containing stage classes and fuel sub-classes.
+    :param delta_time: Time step in seconds
+    :return: Returns the names of the tanks that ran dry during the step, see drain_propellant()
+    """
+    start = time.perf_counter()
+
+    throttle = throttle_setting(rocket)
+    mass_flow, liquid_throttle, srb_throttle = set_propellant_flow(rocket, throttle)
+    atmosphere = atmo.lookup(rocket.altitude)
+    if rocket.recorder is not None:
+        rocket.recorder.record(rocket, throttle, atmosphere.density)
+    mass = rocket.mass
+    set_state(rocket, rk4_step(rocket, get_state(rocket), delta_time, liquid_throttle, srb_throttle, mass_flow,
+                               atmosphere))
+    rocket.mass = mass
+    depleted = drain_propellant(rocket, delta_time)
+    rocket.time += delta_time
+
+    rocket.step_count += 1
+    rocket.step_time += time.perf_counter() - start
+    return depleted
+
+
+def steps_per_second(rocket):
+    """
+    This function reports the integrator throughput.
+    :param rocket: An input rocket containing stage classes and fuel sub-classes.
+    :return: Returns the average number of integrator steps per second of wall time
+    """
+    if rocket.step_time == 0:
+        return 0
+    return rocket.step_count / rocket.step_time
+
+
+def functions(rocket, variables, delta_time, thrust_force=None):
     """
     This function defines the functions that characterize the rockets altitude, velocity and flight path angle (fpa).
     :param delta_time: A vector of times time[0] = t0, time[1] = t1
     :param rocket: An input rocket containing stage classes and fuel sub-classes.
-    :param variables: Variables we are trying to solve for
+    :param variables: Variables we are trying to solve for, the fpa is in radians
+    :param thrust_force: Thrust in Newtons held over the step, None reads the throttle
     :return: Returns functions that characterize the variables. In a format that works with a root solving algorithm.
     0 = ...
     """
@@ -271,44 +492,309 @@ def functions(rocket, variables, delta_time):
 
     altitude_old = rocket.altitude
     velocity_old = rocket.velocity
-    flight_path_angle_old = rocket.flight_path_angle
+    flight_path_angle_old = math.radians(rocket.flight_path_angle)
 
     time_old = delta_time[0]
     time_new = delta_time[1]
 
-    area = rocket.current_stage + ".AREA"
-    drag_coefficient = rocket.current_stage + ".DRAG_COEFFICIENT"
-    mass = rocket.current_stage + ".total_mass"
+    stage = rocket.stage
+
+    if thrust_force is None:
+        thrust_force = thrust(rocket)
+
+    # One atmosphere evaluation per residual call
+    atmosphere = atmo.lookup(altitude)
 
     f = numpy.zeros(3)
 
-    f[0] = -(atmo.gravity(altitude) - velocity ** 2 / (EARTH_RADIUS + altitude)) * math.cos(flight_path_angle)\
-           - velocity * (flight_path_angle - flight_path_angle_old) / (time_new - time_old)
+    if velocity_old > MINIMUM_TURN_VELOCITY:
+        f[0] = -(atmosphere.gravity - velocity ** 2 / (EARTH_RADIUS + altitude)) * math.cos(flight_path_angle)\
+               - velocity * (flight_path_angle - flight_path_angle_old) / (time_new - time_old)
+    else:
+        # Held like in derivatives(), near rest the turn equation would only say cos(fpa) = 0
+        f[0] = flight_path_angle_old - flight_path_angle
+
+    f[1] = (time_new - time_old) * velocity * math.sin(flight_path_angle) - altitude + altitude_old
 
-    f[1] = (time_new - time_old) * velocity * math.sin(flight_path_angle) + altitude - altitude_old
+    f[2] = (time_new - time_old) * ((thrust_force - (0.5 * atmosphere.density * velocity ** 2 *
+           stage.AREA * stage.DRAG_COEFFICIENT)) / rocket.mass \
+           - atmosphere.gravity * math.sin(flight_path_angle)) + velocity_old - velocity
 
-    f[2] = (time_new - time_old) * ((thrust(rocket) - (0.5 * atmo.density(altitude) * velocity ** 2 *
-           getattr_nest(rocket, area) * getattr_nest(rocket, drag_coefficient))) / getattr_nest(rocket, mass) \
-           - atmo.gravity(altitude) * math.sin(flight_path_angle)) + velocity_old - velocity
+    return f
+
+
+def jacobian(rocket, variables, delta_time):
+    """
+    This function calculates the analytic Jacobian of functions() with respect to altitude, velocity and fpa.
+    :param rocket: An input rocket containing stage classes and fuel sub-classes.
+    :param variables: Variables we are trying to solve for, the fpa is in radians
+    :param delta_time: A vector of times time[0] = t0, time[1] = t1
+    :return: Returns a 3x3 numpy array J[i, j] = d f[i] / d variables[j]
+    """
+    altitude = variables[0]
+    velocity = variables[1]
+    flight_path_angle = variables[2]
+
+    flight_path_angle_old = math.radians(rocket.flight_path_angle)
+    dt = delta_time[1] - delta_time[0]
+
+    atmosphere = atmo.lookup(altitude)
+    gravity = atmosphere.gravity
+    gravity_gradient = -2 * gravity / (EARTH_RADIUS + altitude)
+    radius = EARTH_RADIUS + altitude
+    drag_factor = 0.5 * rocket.stage.AREA * rocket.stage.DRAG_COEFFICIENT / rocket.mass
+
+    sin_fpa = math.sin(flight_path_angle)
+    cos_fpa = math.cos(flight_path_angle)
+
+    j = numpy.zeros((3, 3))
+
+    if rocket.velocity > MINIMUM_TURN_VELOCITY:
+        j[0, 0] = -(gravity_gradient + velocity ** 2 / radius ** 2) * cos_fpa
+        j[0, 1] = 2 * velocity / radius * cos_fpa - (flight_path_angle - flight_path_angle_old) / dt
+        j[0, 2] = (gravity - velocity ** 2 / radius) * sin_fpa - velocity / dt
+    else:
+        j[0, 2] = -1
+
+    j[1, 0] = -1
+    j[1, 1] = dt * sin_fpa
+    j[1, 2] = dt * velocity * cos_fpa
+
+    j[2, 0] = dt * (-drag_factor * atmo.lookup_density_gradient(altitude) * velocity ** 2 - gravity_gradient * sin_fpa)
+    j[2, 1] = -dt * 2 * drag_factor * atmosphere.density * velocity - 1
+    j[2, 2] = -dt * gravity * cos_fpa
+
+    return j
+
+
+def implicit_step(rocket, delta_time, tolerance=1e-9, max_iterations=20):
+    """
+    This function advances the rocket by one backward Euler step, solving functions() = 0 with Newton-Raphson and
+    the analytic Jacobian. The solve is warm started by extrapolating the previous step's increment, which usually
+    converges in two or three iterations. Being implicit, it stays stable for the large steps used in fast-forward.
+    At low speed the turn equation can have more than one root, and Newton either cycles between them or lands on one
+    past vertical that the flight cannot reach. Such a step is split in two halves, down to MINIMUM_IMPLICIT_STEP.
+    A rocket with a recorder has each step logged as in step().
+    :param rocket: An input rocket containing stage classes and fuel sub-classes.
+    :param delta_time: Time step in seconds
+    :param tolerance: Relative size of the Newton update at which the solve is considered converged
+    :param max_iterations: Newton iterations allowed before giving up
+    :return: Returns the number of Newton iterations used
+    """
+    start = time.perf_counter()
+
+    times = [rocket.time, rocket.time + delta_time]
+    throttle = throttle_setting(rocket)
+    mass_flow, liquid_throttle, srb_throttle = set_propellant_flow(rocket, throttle)
+    atmosphere = atmo.lookup(rocket.altitude)
+    thrust_force = stage_thrust(rocket.stage, atmosphere.pressure, liquid_throttle, srb_throttle)
+
+    current = numpy.array([rocket.altitude, rocket.velocity, math.radians(rocket.flight_path_angle)])
+    variables = current + rocket.implicit_increment * delta_time
+
+    converged = False
+    for iteration in range(1, max_iterations + 1):
+        update_vector = numpy.linalg.solve(jacobian(rocket, variables, times),
+                                           functions(rocket, variables, times, thrust_force))
+        variables = variables - update_vector
+        if numpy.all(numpy.abs(update_vector) <= tolerance * (1 + numpy.abs(variables))):
+            converged = True
+            break
+
+    # The flight path angle cannot turn through vertical, at exactly vertical the turn rate is zero
+    past_vertical = converged and abs(variables[2]) > math.pi / 2 >= abs(current[2])
+    if past_vertical and abs(variables[2]) - math.pi / 2 <= tolerance * (1 + math.pi / 2):
+        # Rounding in a straight climb or fall
+        variables[2] = math.copysign(math.pi / 2, variables[2])
+    elif past_vertical or not converged:
+        if delta_time / 2 < MINIMUM_IMPLICIT_STEP:
+            raise RuntimeError('implicit step did not converge in ' + str(max_iterations) + ' iterations'
+                               if not converged else 'implicit step turned the flight path angle past vertical')
+        rocket.newton_iterations += iteration
+        rocket.step_time += time.perf_counter() - start
+        return iteration + implicit_step(rocket, delta_time / 2, tolerance, max_iterations) + \
+            implicit_step(rocket, delta_time / 2, tolerance, max_iterations)
+
+    # A split step is logged by its halves, so only a step that is kept whole is recorded here
+    if rocket.recorder is not None:
+        rocket.recorder.record(rocket, throttle, atmosphere.density)
+    rocket.implicit_increment = (variables - current) / delta_time
+    rocket.altitude = float(variables[0])
+    rocket.velocity = float(variables[1])
+    rocket.flight_path_angle = math.degrees(variables[2])
+    drain_propellant(rocket, delta_time)
+    rocket.time += delta_time
+
+    rocket.newton_iterations += iteration
+    rocket.step_count += 1
+    rocket.step_time += time.perf_counter() - start
+    return iteration
+
+
+def throttle_setting(rocket):
+    """
+    This function gets the value from the touch pot throttle and maps it to a fraction of full thrust.
+    :param rocket: An input rocket containing stage classes and fuel sub-classes.
+    :return: Returns the throttle setting between 0 and 1, 1 if the rocket has no throttle attached
+    """
+    if rocket.throttle is None:
+        return 1.0
+    return translate(rocket.throttle.get_current_value(), [rocket.throttle.MIN_VALUE, rocket.throttle.MAX_VALUE],
+                     [0, 1])
 
 
 def thrust(rocket):
     """
-    This function gets the value from the touch pot throttle and maps it to the rocket thrust limits.
+    This function gets the value from the touch pot throttle and maps it to the rocket thrust limits at the current
+    ambient pressure. The SRBs cannot be throttled and empty tanks produce no thrust.
     :param rocket: An input rocket containing stage classes and fuel sub-classes.
     :return: Returns a thrust in Newtons
     """
-    current_value = rocket.throttle.get_current_value()
+    fuel_flow, oxidizer_flow, srb_flow = propellant_flow(rocket, throttle_setting(rocket))
+    liquid_throttle, srb_throttle = engine_throttles(rocket.stage, fuel_flow + oxidizer_flow, srb_flow)
+    return stage_thrust(rocket.stage, atmo.lookup(rocket.altitude).pressure, liquid_throttle, srb_throttle)
+
 
-    if rocket.altitude > 25000:  # If the rocket is in space use the vacuum max thrust value
-        max_thrust = rocket.current_stage + ".THRUST_VAC"
-    else:  # If the rocket is still in the atmosphere use the sea-level max thrust value
-        max_thrust = rocket.current_stage + ".THRUST_SEA"
+def engine_throttles(stage, liquid_flow, srb_flow):
+    """
+    :param stage: A Stage
+    :param liquid_flow: Fuel plus oxidizer mass flow in kg/s
+    :param srb_flow: SRB mass flow in kg/s
+    :return: Returns the fraction of full flow of the liquid engines and of the SRBs
+    """
+    full_flow = stage.fuel.FLOW_RATE_MAX + stage.oxidizer.FLOW_RATE_MAX
+    liquid_throttle = liquid_flow / full_flow if full_flow > 0 else 0
+    srb_throttle = srb_flow / stage.srb.FLOW_RATE_MAX if srb_flow > 0 else 0
+    return liquid_throttle, srb_throttle
 
-    min_thrust = 0
 
-    return translate(current_value, [rocket.throttle.MIN_VALUE, rocket.throttle.MAX_VALUE],
-                     [min_thrust, getattr_nest(rocket, max_thrust)])
+def stage_thrust(stage, pressure, liquid_throttle, srb_throttle):
+    """
+    This function adds up the thrust of the liquid engines and the SRBs. Each comes from its own table, so the core
+    engines keep their own thrust whether or not the SRBs are burning.
+    :param stage: A Stage
+    :param pressure: Ambient pressure in kPa
+    :param liquid_throttle: Fraction of full thrust of the liquid engines
+    :param srb_throttle: Fraction of full thrust of the SRBs
+    :return: Returns the thrust in Newtons
+    """
+    thrust_force = 0
+    if liquid_throttle > 0:
+        thrust_force = liquid_throttle * stage.engine.lookup(pressure)[0]
+    if srb_throttle > 0:
+        thrust_force += srb_throttle * stage.srb_engine.lookup(pressure)[0]
+    return thrust_force
+
+
+def propellant_flow(rocket, throttle):
+    """
+    This function calculates how fast each tank of the active stage empties. The liquid engines are throttled and
+    split their flow by the mixture ratio, and stop if either tank is empty; the SRBs burn at their fixed rate until
+    they are empty.
+    :param rocket: An input rocket containing stage classes and fuel sub-classes.
+    :param throttle: Throttle setting between 0 and 1
+    :return: Returns the fuel, oxidizer and SRB mass flows in kg/s
+    """
+    stage = rocket.stage
+    if stage.fuel.mass > 0 and stage.oxidizer.mass > 0:
+        liquid_flow = throttle * (stage.fuel.FLOW_RATE_MAX + stage.oxidizer.FLOW_RATE_MAX)
+        fuel_flow = liquid_flow / (stage.MIXTURE + 1)
+        oxidizer_flow = liquid_flow - fuel_flow
+    else:
+        fuel_flow = 0
+        oxidizer_flow = 0
+
+    if stage.srb is not None and stage.srb.mass > 0:
+        srb_flow = stage.srb.FLOW_RATE_MAX
+    else:
+        srb_flow = 0
+
+    return fuel_flow, oxidizer_flow, srb_flow
+
+
+def set_propellant_flow(rocket, throttle):
+    """
+    This function sets the flow_rate of every tank in the active stage for the coming step.
+    :param rocket: An input rocket containing stage classes and fuel sub-classes.
+    :param throttle: Throttle setting between 0 and 1
+    :return: Returns the total mass flow in kg/s and the fractions of full thrust of the liquid engines and of the
+    SRBs, see engine_throttles()
+    """
+    stage = rocket.stage
+    stage.fuel.flow_rate, stage.oxidizer.flow_rate, srb_flow = propellant_flow(rocket, throttle)
+    liquid_flow = stage.fuel.flow_rate + stage.oxidizer.flow_rate
+    if stage.srb is not None:
+        stage.srb.flow_rate = srb_flow
+
+    liquid_throttle, srb_throttle = engine_throttles(stage, liquid_flow, srb_flow)
+    return liquid_flow + srb_flow, liquid_throttle, srb_throttle
+
+
+def drain_propellant(rocket, delta_time):
+    """
+    This function empties the active stage's tanks at their flow_rate for one step and takes the same mass off the
+    running vehicle mass, so the vehicle mass never has to be re-summed.
+    :param rocket: An input rocket containing stage classes and fuel sub-classes.
+    :param delta_time: Time step in seconds
+    :return: Returns a tuple naming the tanks that ran dry during the step, e.g. ("stage1.srb",), usually empty
+    """
+    stage = rocket.stage
+    depleted = NO_DEPLETION
+    for name, tank in (("fuel", stage.fuel), ("oxidizer", stage.oxidizer), ("srb", stage.srb)):
+        if tank is None or tank.flow_rate == 0:
+            continue
+        used = tank.flow_rate * delta_time
+        if used >= tank.mass:
+            used = tank.mass
+            tank.flow_rate = 0
+            depleted += (rocket.current_stage + "." + name,)
+        tank.mass -= used
+        rocket.mass -= used
+    return depleted
+
+
+def vehicle_mass(rocket):
+    """
+    This function sums the mass of the vehicle from the active stage down. It is only needed when the vehicle
+    changes, e.g. after staging or refuelling; in flight drain_propellant() keeps rocket.mass up to date.
+    :param rocket: An input rocket containing stage classes and fuel sub-classes.
+    :return: Returns the vehicle mass in kg
+    """
+    stage = rocket.stage
+    mass = stage.DEAD_MASS + stage.PAYLOAD_MASS + stage.fuel.mass + stage.oxidizer.mass
+    if stage.srb is not None:
+        mass += stage.srb.mass
+    return mass
+
+
+def specific_impulse(rocket):
+    """
+    This function returns the specific impulse at the current ambient pressure. While the SRBs burn it is the
+    average of the SRBs and the liquid engines weighted by their mass flow.
+    :param rocket: An input rocket containing stage classes and fuel sub-classes.
+    :return: Returns the specific impulse in seconds
+    """
+    stage = rocket.stage
+    pressure = atmo.lookup(rocket.altitude).pressure
+    fuel_flow, oxidizer_flow, srb_flow = propellant_flow(rocket, throttle_setting(rocket))
+    isp = stage.engine.lookup(pressure)[1]
+    if srb_flow == 0:
+        return isp
+    liquid_flow = fuel_flow + oxidizer_flow
+    return (liquid_flow * isp + srb_flow * stage.srb_engine.lookup(pressure)[1]) / (liquid_flow + srb_flow)
+
+
+def set_stage(rocket, stage_name):
+    """
+    This function makes a stage the active one. The stage object is resolved here, once per staging, and cached on
+    rocket.stage so the physics reads its constants directly instead of building and resolving attribute strings.
+    :param rocket: An input rocket containing stage classes and fuel sub-classes.
+    :param stage_name: Name of the stage attribute, e.g. "stage2"
+    :return: Returns the active Stage object
+    """
+    rocket.current_stage = stage_name
+    rocket.stage = getattr(rocket, stage_name)
+    return rocket.stage
 
 
 def translate(value, range1, range2):
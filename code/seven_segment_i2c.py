@@ -29,24 +29,173 @@ class DotEnum:
     APOSTROPHE = 0b00100000  # nnn'n
 
 
+# Characters sent for numbers, the display firmware takes ASCII
+BLANK = ord(' ')
+MINUS = ord('-')
+OVERFLOW = ord('-')  # Shown in every position when a number does not fit
+# Precomputed (tens, ones) characters for 0 to 99, so numbers are
+# split two digits at a time without building strings
+DIGIT_PAIRS = tuple((ord('0') + i // 10, ord('0') + i % 10) for i in range(100))
+
+
+class NumberFormatter:
+    """
+    Lays a number out over a chain of four digit
+    displays, leftmost display first. Handles
+    integers, fixed point decimals shown with
+    the DotEnum decimal points, negatives and
+    numbers too wide to fit
+    """
+    def __init__(self, display_count, decimals=0, leading_zeros=False):
+        """
+        display_count is the number of displays in
+        the chain, decimals the number of digits
+        shown after the decimal point
+        """
+        self.width = 4 * display_count
+        self.decimals = decimals
+        self.scale = 10 ** decimals
+        self.leading_zeros = leading_zeros
+        if decimals >= self.width:
+            raise ValueError('at least one digit has to be left of the decimal point')
+
+        # one frame of digit characters and a dot mask per
+        # display, reused for every number
+        self.digits = [BLANK] * self.width
+        self.frames = [(self.digits[i:i + 4], 0) for i in range(0, self.width, 4)]
+        # the decimal point sits after the last digit left of it
+        point = self.width - 1 - decimals
+        self.dots = [0] * display_count
+        if decimals > 0:
+            self.dots[point // 4] = DotEnum.DECIMAL_1 << (point % 4)
+
+    def format(self, value):
+        """
+        Returns a list of (digits, dots) frames, one
+        per display, ready for write_frame. The lists
+        are reused by the next call
+        """
+        digits = self.digits
+        # halves round away from zero, round() would show
+        # 2.5 as 2 and -0.5 as 0
+        number = int(abs(value) * self.scale + 0.5)
+        # no minus sign for values that round to zero
+        negative = value < 0 and number > 0
+
+        # fill from the right two digits at a time, the width
+        # is even so a single digit is only ever left at the end
+        position = self.width
+        while number >= 10 and position >= 2:
+            number, pair = divmod(number, 100)
+            position -= 2
+            digits[position], digits[position + 1] = DIGIT_PAIRS[pair]
+        if number > 0 or position == self.width:
+            if position == 0:
+                return self.overflow()
+            position -= 1
+            digits[position] = DIGIT_PAIRS[number][1]
+
+        # a pair may have left a zero in front of the number
+        first = self.width - 1 - self.decimals
+        while position < first and digits[position] == DIGIT_PAIRS[0][1]:
+            position += 1
+        # zeros between the decimal point and the number
+        for i in range(first, position):
+            digits[i] = DIGIT_PAIRS[0][1]
+        position = min(position, first)
+
+        if self.leading_zeros:
+            for i in range(position):
+                digits[i] = DIGIT_PAIRS[0][1]
+            if negative:
+                if digits[0] != DIGIT_PAIRS[0][1]:
+                    return self.overflow()
+                digits[0] = MINUS
+        else:
+            if negative:
+                if position == 0:
+                    return self.overflow()
+                position -= 1
+                digits[position] = MINUS
+            for i in range(position):
+                digits[i] = BLANK
+        return self.split(self.dots)
+
+    def overflow(self):
+        """
+        Returns the frames shown for a number that
+        does not fit
+        """
+        for i in range(self.width):
+            self.digits[i] = OVERFLOW
+        return self.split([0] * len(self.dots))
+
+    def split(self, dots):
+        """
+        Copies the digits into the per display frames
+        """
+        for display in range(len(self.frames)):
+            frame = self.frames[display][0]
+            frame[:] = self.digits[4 * display:4 * display + 4]
+            self.frames[display] = (frame, dots[display])
+        return self.frames
+
+
+def brightness_byte(percent):
+    """
+    Converts a brightness percentage to the
+    0-255 level the display expects
+    """
+    if (percent < 0) or (percent > 100):
+        print('invalid percentage for brightness, setting to medium level')
+        percent = 50
+
+    # brightness level can be set from 0 to 255
+    return int((percent / 100.0) * 255)
+
+
 class SevenSegmentDisplay:
     """
     Controls a Sparkfun 7 Segment display via i2c
     https://learn.sparkfun.com/tutorials/using-the-serial-7-segment-display/firmware-overview
     Note: this code is not a Sparkfun product, use at your own risk!
     """
-    def __init__(self, address):
+    def __init__(self, address, busnum=2):
         """
         Takes a data bus to communicate over, should
         be an I2C bus that implements write_byte
         """
         self.address = address
-        self.bus = Adafruit_I2C.Device(address, busnum=2)
+        self.busnum = busnum
+        self.bus = Adafruit_I2C.Device(address, busnum=busnum)
 
         # segment control registers for each digit
         # starting with the leftmost digit
         self.segment_addresses = [0x7B, 0x7C, 0x7D, 0x7E]
 
+        # shadow framebuffer of what the display shows, so
+        # writes of unchanged content can be skipped
+        self.invalidate()
+
+        # used by display_int when this is the left display
+        # of a pair, kept per display so calls from different
+        # bus workers never share one formatter's buffers
+        self.pair_formatter = NumberFormatter(2)
+
+    def invalidate(self):
+        """
+        Forgets what the display shows, the next
+        write of each item is sent in full. Used
+        when the display state is unknown, e.g.
+        after a failed write
+        """
+        # ('digit', byte) or ('segments', bitmask) for
+        # each position, None where it is unknown
+        self.shadow = [None] * 4
+        self.shadow_dots = None
+        self.shadow_brightness = None
+        self.cursor = None
+
     def validate_digit(self, cmd):
         """
         Ensure that the digit data we're being
@@ -77,36 +226,130 @@ class SevenSegmentDisplay:
                 print('caught exception writing ' + str(hex(value)) + ' remaining: ' + str(retry_count))
                 # raise
                 if retry_count <= 0:
+                    # part of the command may have been applied,
+                    # so the shadow no longer matches the display
+                    self.invalidate()
+                    # rethrow the exception if we're done retrying
+                    raise
+
+    def write_block(self, values):
+        """
+        Writes a list of bytes in a single I2C
+        transaction. The display reads them as
+        if they had been sent one at a time
+        with write_byte
+        """
+        retry_count = 2
+        while retry_count > 0:
+            try:
+                # the first byte goes out as the 'register'
+                # of an SMBus block write, the rest follow it
+                self.bus.writeList(values[0], values[1:])
+                retry_count = 0
+            except IOError as ex:
+                retry_count -= 1
+                # add a delay in case the bus was busy
+                time.sleep(0.1)
+                print('caught exception writing ' + str([hex(value) for value in values]) + ' remaining: ' +
+                      str(retry_count))
+                if retry_count <= 0:
+                    self.invalidate()
                     # rethrow the exception if we're done retrying
                     raise
 
+    def frame_bytes(self, digits, dots=None, brightness=None):
+        """
+        Builds the byte stream that turns what the
+        shadow says is shown into the given frame:
+        the four digits from the leftmost, then
+        optionally the DotEnum bitmask and the
+        brightness as a percentage. Unchanged items
+        are left out, so an identical frame gives
+        an empty list
+        """
+        values = []
+        sending = False
+        for position in range(4):
+            if self.shadow[position] == ('digit', digits[position]):
+                sending = False
+                continue
+            if not sending:
+                # move the cursor to the start of each changed run,
+                # it advances by itself after each digit
+                values += [0x79, position]
+                sending = True
+            values.append(digits[position])
+        if dots is not None and dots != self.shadow_dots:
+            values += [0x77, dots]
+        if brightness is not None:
+            level = brightness_byte(brightness)
+            if level != self.shadow_brightness:
+                values += [0x7A, level]
+        return values
+
+    def write_frame(self, digits, dots=None, brightness=None):
+        """
+        Writes all four digits, and optionally
+        the dots and the brightness, in one bus
+        transaction instead of a cursor command
+        and a digit write per position. Only what
+        differs from the shadow is sent
+        """
+        if len(digits) != 4:
+            print('a frame needs exactly four digits')
+            return
+        digits = list(digits)
+        for position in range(4):
+            if self.validate_digit(digits[position]):
+                # a command byte would be executed instead of shown
+                print('invalid digit ' + str(hex(digits[position])) + ', writing a blank')
+                digits[position] = ord(' ')
+
+        values = self.frame_bytes(digits, dots, brightness)
+        if not values:
+            return
+        self.write_block(values)
+
+        changed = [position for position in range(4) if self.shadow[position] != ('digit', digits[position])]
+        if changed:
+            # the cursor is left after the last digit sent
+            self.cursor = (changed[-1] + 1) % 4
+        for position in range(4):
+            self.shadow[position] = ('digit', digits[position])
+        if dots is not None:
+            self.shadow_dots = dots
+        if brightness is not None:
+            self.shadow_brightness = brightness_byte(brightness)
+
     def restore_factory_defaults(self):
         """
         Restore factory defaults of the display
         """
         self.write_byte(0x81)
+        self.invalidate()
 
     def clear_display(self):
         """
         blanks the display
         """
         self.write_byte(0x76)
+        # clearing also moves the cursor home
+        self.shadow = [('digit', ord(' '))] * 4
+        self.cursor = 0
 
     def set_brightness_level(self, percent):
         """
         Sets the brightness level as a percentage
         of total brightness
         """
-        if (percent < 0) or (percent > 100):
-            print('invalid percentage for brightness, setting to medium level')
-            percent = 50
-        
-        # brightness level can be set from 0 to 255
-        val = int((percent / 100.0) * 255)
+        val = brightness_byte(percent)
+        if val == self.shadow_brightness:
+            return
         # write the control address
         self.write_byte(0x7A)
         # then write the brightness level
         self.write_byte(val)
+        self.shadow_brightness = val
 
     def set_cursor_position(self, position):
         """
@@ -116,6 +359,7 @@ class SevenSegmentDisplay:
         if (position >= 0) and (position <= 3):
             self.write_byte(0x79)
             self.write_byte(position)
+            self.cursor = position
         else:
             print('invalid position ' + str(position))
 
@@ -129,6 +373,8 @@ class SevenSegmentDisplay:
         val = 0
         for dot in dots:
             val = val | dot
+        if val == self.shadow_dots:
+            return
 
         # write the command first
         self.write_byte(0x77)
@@ -137,6 +383,7 @@ class SevenSegmentDisplay:
         # TODO: can we read the existing mask to
         # just turn on additional things???
         self.write_byte(val)
+        self.shadow_dots = val
 
     def write_digit(self, digit):
         """
@@ -147,12 +394,20 @@ class SevenSegmentDisplay:
         """
         if not self.validate_digit(digit):
             self.write_byte(digit)
+            if self.cursor is not None:
+                self.shadow[self.cursor] = ('digit', digit)
+                self.cursor = (self.cursor + 1) % 4
+            else:
+                # the digit landed somewhere unknown
+                self.shadow = [None] * 4
 
     def write_digit_to_position(self, position, digit):
         """
         Write a digit to the display at a specified
-        position
+        position, unless it already shows it
         """
+        if (0 <= position <= 3) and self.shadow[position] == ('digit', digit):
+            return
         self.set_cursor_position(position)
         self.write_digit(digit)
 
@@ -166,10 +421,13 @@ class SevenSegmentDisplay:
             val = 0
             for seg in segments:
                 val = val | seg
+            if self.shadow[position] == ('segments', val):
+                return
             # write to the control register for the digit whose segments
             # we're updating
             self.write_byte(self.segment_addresses[position])
             self.write_byte(val)
+            self.shadow[position] = ('segments', val)
         else:
             print('invalid position', position)
 
@@ -197,27 +455,28 @@ class SevenSegmentDisplay:
         fill_str = digits_to_fill * str_fill_char
         write_str = fill_str + str_val
 
-        for i in range(len(write_str)):
-            self.write_digit_to_position(i, ord(write_str[i]))
+        self.write_frame([ord(char) for char in write_str])
 
 
 def display_int(value, left, right):
     """
-    This function displays integers up to 8 characters in length on two 4 digit 7-segment displays.
+    This function displays integers up to 8 characters in length on two 4 digit 7-segment displays. It uses the
+    left display's formatter, so nothing is built per call and pairs written from different threads never share one.
     :param value: Integer to be displayed
     :param left: SevenSegmentDisplay object: Left 4 digit 7-segment display
     :param right: SevenSegmentDisplay object: Right 4 digit 7-segment display
     :return: displays the integer on the displays
     """
-    value_array = [int(i) for i in str(value)]
+    display_number(value, [left, right], left.pair_formatter)
 
-    # Separate the last four digits from the rest of the array
-    right_values = value_array[-4:]
-    left_values = value_array[:(len(value_array) - 4)]
 
-    # Convert the arrays into integers
-    right_values = int(''.join(map(str, right_values)))
-    left_values = int(''.join(map(str, left_values)))
-
-    left.write_int(left_values)
-    right.write_int(right_values)
+def display_number(value, displays, formatter):
+    """
+    This function displays a number on a chain of 4 digit 7-segment displays.
+    :param value: Number to be displayed
+    :param displays: List of SevenSegmentDisplay objects, leftmost first
+    :param formatter: NumberFormatter for len(displays) displays
+    :return: displays the number on the displays
+    """
+    for display, (digits, dots) in zip(displays, formatter.format(value)):
+        display.write_frame(digits, dots)
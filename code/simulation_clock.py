@@ -0,0 +1,100 @@
+import time
+
+
+class SimulationClock:
+    """
+    Paces a main loop. Physics advances in fixed delta_time steps however long each frame takes: wall time is
+    collected in an accumulator and tick() says how many steps are due. The loop renders once per frame and
+    interpolates between the last two physics states with alpha(), then wait() sleeps until the next frame.
+
+        clock = SimulationClock(0.01, frame_rate=20)
+        while running:
+            for i in range(clock.tick()):
+                step()
+            render(clock.interpolate(previous, current))
+            clock.wait()
+    """
+    def __init__(self, delta_time, frame_rate=None, max_steps=None, clock=time.monotonic, sleep=time.sleep):
+        """
+        :param delta_time: Physics time step in seconds
+        :param frame_rate: Frames per second of wall time, one step per frame by default
+        :param max_steps: Most steps run in one frame, wall time beyond that is dropped so a stalled loop does not
+        spiral into ever longer catch-ups. Four frames' worth by default
+        :param clock: Function returning the wall time in seconds
+        :param sleep: Function sleeping for a number of seconds
+        """
+        self.delta_time = delta_time
+        self.frame_period = delta_time if frame_rate is None else 1.0 / frame_rate
+        self.steps_per_frame = max(int(round(self.frame_period / delta_time)), 1)
+        self.max_steps = 4 * self.steps_per_frame if max_steps is None else max_steps
+        self.clock = clock
+        self.sleep = sleep
+
+        # -------------------VARIABLES-------------------
+        self.time = 0.0  # Simulation time [s]
+        self.accumulator = 0.0  # Wall time not yet turned into steps [s]
+        self.last_tick = None  # Wall time of the last tick [s]
+        self.next_frame = None  # Wall time the next frame is due [s]
+
+        # -------------------PERFORMANCE-------------------
+        self.frames = 0  # Number of ticks
+        self.steps = 0  # Number of physics steps handed out
+        self.catch_up_steps = 0  # Steps beyond steps_per_frame, run to make up for late frames
+        self.dropped_steps = 0  # Steps skipped because a frame would have needed more than max_steps
+        self.overruns = 0  # Frames whose work took longer than the frame period
+        self.worst_latency = 0.0  # Longest a tick came after its frame was due [s]
+
+    def tick(self):
+        """
+        This function starts a frame.
+        :return: Returns the number of physics steps to run this frame
+        """
+        now = self.clock()
+        if self.last_tick is None:
+            self.last_tick = now
+            self.next_frame = now
+        self.worst_latency = max(self.worst_latency, now - self.next_frame)
+        self.accumulator += now - self.last_tick
+        self.last_tick = now
+        self.next_frame += self.frame_period
+        if self.next_frame < now:
+            # More than a frame behind, start the schedule again from now instead of rushing through the backlog
+            self.next_frame = now + self.frame_period
+
+        steps = int(self.accumulator / self.delta_time)
+        if steps > self.max_steps:
+            self.dropped_steps += steps - self.max_steps
+            self.accumulator -= (steps - self.max_steps) * self.delta_time
+            steps = self.max_steps
+        self.accumulator -= steps * self.delta_time
+        self.time += steps * self.delta_time
+
+        self.frames += 1
+        self.steps += steps
+        self.catch_up_steps += max(steps - self.steps_per_frame, 0)
+        return steps
+
+    def alpha(self):
+        """
+        :return: Returns how far between the last two physics states the wall clock is, between 0 and 1
+        """
+        return self.accumulator / self.delta_time
+
+    def interpolate(self, previous, current):
+        """
+        :param previous: Value before the last physics step
+        :param current: Value after the last physics step
+        :return: Returns the value to render this frame
+        """
+        return previous + (current - previous) * self.alpha()
+
+    def wait(self):
+        """
+        This function ends a frame by sleeping until the next one is due.
+        :return: Nothing is returned
+        """
+        remaining = self.next_frame - self.clock()
+        if remaining > 0:
+            self.sleep(remaining)
+        else:
+            self.overruns += 1
@@ -0,0 +1,180 @@
+import heapq
+import propagator
+import rocket as rocket_model
+
+
+class StagingEvent:
+    """
+    One step of the staging sequence. An event is armed by exactly one condition: a mission time, a set of tanks
+    running dry, an altitude crossing or another event firing. Once its condition holds the event is queued delay
+    seconds later and its action is run on the rocket when the queue reaches it.
+    """
+    def __init__(self, name, action=None, time=None, tanks=(), altitude=None, after=None, delay=0.0):
+        """
+        :param name: Name of the event, e.g. "srb_separation"
+        :param action: Function action(rocket) run when the event fires, None for a marker event
+        :param time: Mission time in seconds at which the event fires
+        :param tanks: Tank names, e.g. ("stage2.fuel", "stage2.oxidizer"), the event is armed when any runs dry
+        :param altitude: Altitude in meters, the event is armed when the rocket climbs through it
+        :param after: Name of the event that arms this one
+        :param delay: Seconds between the condition holding and the event firing
+        """
+        if sum([time is not None, len(tanks) > 0, altitude is not None, after is not None]) != 1:
+            raise ValueError('staging event ' + name + ' needs exactly one of time, tanks, altitude or after')
+        self.name = name
+        self.action = action
+        self.time = time
+        self.tanks = tuple(tanks)
+        self.altitude = altitude
+        self.after = after
+        self.delay = delay
+
+
+# -------------------ACTIONS-------------------
+def activate(stage_name):
+    """
+    :param stage_name: Name of the stage attribute, e.g. "stage3"
+    :return: Returns an action that drops everything below stage_name and makes it the active stage
+    """
+    def action(rocket):
+        rocket_model.set_stage(rocket, stage_name)
+        rocket.mass = rocket_model.vehicle_mass(rocket)
+    return action
+
+
+def separate_srbs(rocket):
+    """
+    This function drops the solid rocket boosters. stage1 and stage2 share the core tanks, so whatever is left in
+    stage1's core tanks is carried over to stage2 before it takes over.
+    :param rocket: An input rocket containing stage classes and fuel sub-classes.
+    :return: Nothing is returned
+    """
+    rocket.stage2.fuel.mass = rocket.stage1.fuel.mass
+    rocket.stage2.oxidizer.mass = rocket.stage1.oxidizer.mass
+    activate('stage2')(rocket)
+
+
+def sls_sequence():
+    """
+    :return: Returns the staging sequence of the SLS Block 1 vehicle as a list of StagingEvents
+    """
+    return [StagingEvent('srb_separation', separate_srbs, tanks=('stage1.srb',)),
+            StagingEvent('core_meco', tanks=('stage2.fuel', 'stage2.oxidizer')),
+            StagingEvent('upper_stage_ignition', activate('stage3'), after='core_meco', delay=12.0),
+            StagingEvent('upper_stage_cutoff', tanks=('stage3.fuel', 'stage3.oxidizer')),
+            StagingEvent('orion_separation', activate('stage4'), after='upper_stage_cutoff', delay=5.0)]
+
+
+class StagingEngine:
+    """
+    Runs a staging sequence against a rocket. Armed events wait in a heap ordered by firing time, so finding the
+    next event is O(1) and the integrator can be told exactly how far it may go before anything changes.
+    """
+    def __init__(self, rocket, sequence=None):
+        """
+        :param rocket: An input rocket containing stage classes and fuel sub-classes.
+        :param sequence: List of StagingEvents, sls_sequence() by default
+        """
+        self.rocket = rocket
+        self.queue = []  # Heap of (time, order, StagingEvent) for armed events
+        self.order = 0  # Tie breaker so events armed for the same time fire in sequence order
+        self.tanks = []  # (StagingEvent, [Propellant]) waiting for a tank to run dry
+        self.altitudes = []  # StagingEvents waiting for an altitude crossing
+        self.followers = {}  # Event name: [StagingEvent] armed when that event fires
+        self.history = []  # (time, name) of every event that has fired
+
+        for event in sls_sequence() if sequence is None else sequence:
+            if event.time is not None:
+                self.arm(event, event.time)
+            elif event.tanks:
+                # Tank names are resolved once here so the per step check is a plain attribute read
+                self.tanks.append((event, [rocket_model.getattr_nest(rocket, name) for name in event.tanks]))
+            elif event.altitude is not None:
+                self.altitudes.append(event)
+            else:
+                self.followers.setdefault(event.after, []).append(event)
+
+    def arm(self, event, condition_time):
+        """
+        This function queues an event whose condition held at condition_time.
+        :return: Nothing is returned
+        """
+        heapq.heappush(self.queue, (condition_time + event.delay, self.order, event))
+        self.order += 1
+
+    def next_time(self):
+        """
+        :return: Returns the mission time of the next queued event, None if nothing is queued
+        """
+        if self.queue:
+            return self.queue[0][0]
+        return None
+
+    def check(self):
+        """
+        This function arms the events whose tank or altitude condition holds now.
+        :return: Nothing is returned
+        """
+        rocket = self.rocket
+        for entry in [entry for entry in self.tanks if any(tank.mass <= 0 for tank in entry[1])]:
+            self.tanks.remove(entry)
+            self.arm(entry[0], rocket.time)
+        for event in [event for event in self.altitudes if rocket.altitude >= event.altitude]:
+            self.altitudes.remove(event)
+            self.arm(event, rocket.time)
+
+    def fire_due(self):
+        """
+        This function runs every queued event that is due, including events armed by the ones that fire.
+        :return: Returns the names of the events that fired
+        """
+        rocket = self.rocket
+        fired = []
+        self.check()
+        while self.queue and self.queue[0][0] <= rocket.time + 1e-9:
+            event = heapq.heappop(self.queue)[2]
+            if event.action is not None:
+                event.action(rocket)
+            self.history.append((rocket.time, event.name))
+            fired.append(event.name)
+            for follower in self.followers.pop(event.name, []):
+                self.arm(follower, rocket.time)
+            # Staging changes the active tanks, which may already be dry
+            self.check()
+        return fired
+
+    def integrator_events(self):
+        """
+        :return: Returns propagator Events for the altitude conditions still waiting, so the integrator stops on them
+        """
+        return [propagator.Event(event.name, lambda t, y, level=event.altitude: y[rocket_model.ALTITUDE] - level, 1)
+                for event in self.altitudes]
+
+    def step(self, delta_time):
+        """
+        This function advances the rocket by one fixed step and stages when due.
+        :param delta_time: Time step in seconds
+        :return: Returns the names of the events that fired
+        """
+        rocket_model.step(self.rocket, delta_time)
+        return self.fire_due()
+
+    def fly(self, duration, max_step=float('inf')):
+        """
+        This function propagates the rocket with adaptive steps and stages when due. Each propagation runs up to the
+        next queued event, or until a tank runs dry or an altitude is crossed, so the integrator takes the largest
+        steps its tolerance allows between events instead of checking the conditions every tick.
+        :param duration: Time to fly in seconds
+        :param max_step: Largest allowed step size in seconds
+        :return: Returns the names of the events that fired
+        """
+        rocket = self.rocket
+        end = rocket.time + duration
+        fired = self.fire_due()
+        while rocket.time < end - 1e-9:
+            stop = end
+            if self.queue:
+                stop = min(stop, self.queue[0][0])
+            propagator.propagate(rocket, stop - rocket.time, events=self.integrator_events(), max_step=max_step)
+            fired += self.fire_due()
+        return fired
@@ -0,0 +1,140 @@
+import numpy
+import vehicle
+
+# One record per physics step
+TELEMETRY_TYPE = numpy.dtype([('time', numpy.float64),  # Mission time [s]
+                              ('altitude', numpy.float64),  # [m]
+                              ('velocity', numpy.float64),  # [m/s]
+                              ('flight_path_angle', numpy.float32),  # [degrees]
+                              ('mass', numpy.float64),  # [kg]
+                              ('throttle', numpy.float32),  # Throttle setting between 0 and 1
+                              ('dynamic_pressure', numpy.float32),  # [kPa]
+                              ('stage', numpy.uint8)])  # Active stage number, 1 for stage1
+
+BLOCK_SIZE = 4096  # Records kept in memory between flushes
+CAPACITY = 360000  # Records the log file is first sized for, one hour at 100 Hz
+
+MAGIC = b'\x93NUMPY\x01\x00'  # .npy format version 1.0
+HEADER_SIZE = 256  # Bytes reserved for the .npy header, room for the descriptor and a 20 digit record count
+
+
+def npy_header(count, dtype=TELEMETRY_TYPE):
+    """
+    This function builds a .npy header padded to HEADER_SIZE bytes, so the record count can be rewritten in place
+    while the data behind it stays put.
+    :param count: Number of records in the file
+    :param dtype: Record type
+    :return: Returns the header as bytes
+    """
+    header = "{'descr': " + repr(numpy.lib.format.dtype_to_descr(dtype)) + \
+             ", 'fortran_order': False, 'shape': (" + str(count) + ",), }"
+    padding = HEADER_SIZE - len(MAGIC) - 2 - len(header) - 1
+    if padding < 0:
+        raise ValueError('record type is too large for a ' + str(HEADER_SIZE) + ' byte header')
+    header_length = HEADER_SIZE - len(MAGIC) - 2
+    return MAGIC + bytes([header_length & 0xFF, header_length >> 8]) + (header + ' ' * padding + '\n').encode('latin1')
+
+
+class FlightRecorder:
+    """
+    Records every physics step into a preallocated ring of BLOCK_SIZE records. When the ring is full it is copied in
+    one go into a memory-mapped .npy file, so recording allocates nothing per step and the file is written in large
+    blocks. The header is rewritten after every flush, so the log is readable up to the last flush even if the
+    program dies. Set it as rocket.recorder and rocket.step(), rocket.implicit_step() and propagator.propagate() log
+    each step they take.
+    """
+    def __init__(self, file_name, block_size=BLOCK_SIZE, capacity=CAPACITY):
+        """
+        :param file_name: .npy file to write, overwritten if it exists
+        :param block_size: Records kept in memory between flushes
+        :param capacity: Records the file is first sized for, it doubles whenever it fills up
+        """
+        self.buffer = numpy.zeros(block_size, dtype=TELEMETRY_TYPE)
+        # Column views of the buffer, writing through them avoids building a record per step
+        self.time = self.buffer['time']
+        self.altitude = self.buffer['altitude']
+        self.velocity = self.buffer['velocity']
+        self.flight_path_angle = self.buffer['flight_path_angle']
+        self.mass = self.buffer['mass']
+        self.throttle = self.buffer['throttle']
+        self.dynamic_pressure = self.buffer['dynamic_pressure']
+        self.stage = self.buffer['stage']
+        self.index = 0  # Next free record in the buffer
+        self.count = 0  # Records flushed to the file
+
+        self.file = open(file_name, 'wb+')
+        self.file.write(npy_header(0))
+        self.capacity = capacity
+        self.log = numpy.memmap(self.file, dtype=TELEMETRY_TYPE, mode='r+', offset=HEADER_SIZE, shape=(capacity,))
+
+    def record(self, rocket, throttle, density):
+        """
+        This function appends the rocket's state at the start of a step. The physics calls it with the throttle and
+        density it already worked out for the step, so recording does no atmosphere lookups of its own.
+        :param rocket: An input rocket containing stage classes and fuel sub-classes.
+        :param throttle: Throttle setting used for the step
+        :param density: Atmospheric density at the rocket's altitude [kg/m^3]
+        :return: Nothing is returned
+        """
+        i = self.index
+        self.time[i] = rocket.time
+        self.altitude[i] = rocket.altitude
+        self.velocity[i] = rocket.velocity
+        self.flight_path_angle[i] = rocket.flight_path_angle
+        self.mass[i] = rocket.mass
+        self.throttle[i] = throttle
+        self.dynamic_pressure[i] = 0.5 * density * rocket.velocity ** 2 / 1000
+        self.stage[i] = vehicle.STAGE_NAMES.index(rocket.current_stage) + 1
+        self.index = i + 1
+        if self.index == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        """
+        This function copies the buffered records to the file and empties the buffer.
+        :return: Nothing is returned
+        """
+        if self.index == 0:
+            return
+        end = self.count + self.index
+        if end > self.capacity:
+            # Remapping a longer view extends the file, nothing already written is copied
+            self.log.flush()
+            self.capacity = max(2 * self.capacity, end)
+            self.log = numpy.memmap(self.file, dtype=TELEMETRY_TYPE, mode='r+', offset=HEADER_SIZE,
+                                    shape=(self.capacity,))
+        self.log[self.count:end] = self.buffer[:self.index]
+        self.log.flush()
+        self.count = end
+        self.index = 0
+
+        self.file.seek(0)
+        self.file.write(npy_header(self.count))
+        self.file.flush()
+
+    def close(self):
+        """
+        This function flushes the remaining records and trims the file to the records written.
+        :return: Nothing is returned
+        """
+        if self.file.closed:
+            return
+        self.flush()
+        self.log = None
+        self.file.truncate(HEADER_SIZE + self.count * TELEMETRY_TYPE.itemsize)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def load(file_name):
+    """
+    This function opens a recorded flight without reading it, pages are loaded as they are accessed.
+    :param file_name: .npy file written by a FlightRecorder
+    :return: Returns a read-only TELEMETRY_TYPE array
+    """
+    return numpy.load(file_name, mmap_mode='r')
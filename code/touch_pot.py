@@ -1,3 +1,5 @@
+import time
+import threading
 import smbus
 
 
@@ -20,3 +22,88 @@ class TouchPot:
         :return: Returns the current potentiometer reading
         """
         return self.bus.read_byte(self.address)
+
+
+class ThrottleSampler:
+    """
+    Polls a TouchPot on a background thread and publishes the latest reading, so readers never wait on the I2C bus.
+    The reading and its timestamp are published together as one tuple; replacing an attribute is atomic, so readers
+    need no lock and always see a matching pair.
+    """
+    def __init__(self, touch_pot, rate=50, smoothing=0.0):
+        """
+        :param touch_pot: TouchPot to poll
+        :param rate: Polling rate in Hz
+        :param smoothing: Exponential smoothing factor, 0 publishes raw readings and values closer to 1 smooth more
+        """
+        self.touch_pot = touch_pot
+        self.MIN_VALUE = touch_pot.MIN_VALUE
+        self.MAX_VALUE = touch_pot.MAX_VALUE
+        self.period = 1.0 / rate
+        self.smoothing = smoothing
+
+        # -------------------VARIABLES-------------------
+        self.sample = (self.MIN_VALUE, 0.0)  # (reading, time.monotonic() of the reading)
+        self.sample_count = 0
+        self.error_count = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """
+        Takes a first reading and starts the polling thread. If the first reading fails the sampler starts at zero
+        throttle, with no timestamp so it reads as stale, and the thread keeps retrying.
+        :return: Returns self so it can be chained after the constructor
+        """
+        try:
+            self.sample = (self.touch_pot.get_current_value(), time.monotonic())
+        except IOError:
+            self.sample = (self.MIN_VALUE, 0.0)
+            self.error_count += 1
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name='throttle-sampler')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the polling thread and waits for it to finish.
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        next_time = time.monotonic()
+        while not self.stop_event.is_set():
+            try:
+                reading = self.touch_pot.get_current_value()
+            except IOError:
+                # Keep publishing the last good reading, its timestamp shows how stale it is
+                self.error_count += 1
+            else:
+                value = self.sample[0]
+                self.sample = (value + (1 - self.smoothing) * (reading - value), time.monotonic())
+                self.sample_count += 1
+
+            next_time += self.period
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                self.stop_event.wait(delay)
+            else:
+                # We fell behind, don't try to catch up with a burst of reads
+                next_time = time.monotonic()
+
+    def get_current_value(self):
+        """
+        :return: Returns the latest potentiometer reading without touching the bus
+        """
+        return self.sample[0]
+
+    def age(self):
+        """
+        :return: Returns the age of the latest reading in seconds
+        """
+        return time.monotonic() - self.sample[1]
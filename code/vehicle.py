@@ -0,0 +1,239 @@
+import os
+import json
+import pickle
+import hashlib
+import tempfile
+import collections
+import atmospheric_model as atmo
+try:
+    import tomllib
+except ImportError:  # Python < 3.11, only JSON definitions can be read
+    tomllib = None
+
+VEHICLE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vehicles')
+CACHE_DIRECTORY = os.path.join(VEHICLE_DIRECTORY, 'cache')
+DEFAULT_VEHICLE = os.path.join(VEHICLE_DIRECTORY, 'sls_block1.json')
+
+# Bump this whenever compile() changes so stale cached vehicles are rebuilt
+COMPILER_VERSION = 3
+
+# Compiled, immutable vehicle description. Field names match the Rocket, Stage and Propellant attributes.
+PropellantDefinition = collections.namedtuple('PropellantDefinition',
+                                              ['MASS_MAX', 'PRESSURE_RANGE', 'FLOW_RATE_MAX', 'NAME', 'mass',
+                                               'pressure', 'flow_rate'])
+StageDefinition = collections.namedtuple('StageDefinition',
+                                         ['NAME', 'DESCRIPTION', 'THRUST_SEA', 'THRUST_VAC', 'ISP_SEA', 'ISP_VAC',
+                                          'MIXTURE', 'PROPELLANT_MASS', 'DEAD_MASS', 'PAYLOAD_MASS', 'DIAMETER',
+                                          'AREA', 'DRAG_COEFFICIENT', 'SRB_THRUST_SEA', 'SRB_THRUST_VAC',
+                                          'SRB_ISP_SEA', 'SRB_ISP_VAC', 'fuel', 'oxidizer', 'srb', 'total_mass'])
+VehicleDefinition = collections.namedtuple('VehicleDefinition', ['NAME', 'FLIGHT_PATH_ANGLE', 'stages', 'HASH'])
+
+STAGE_NAMES = ['stage1', 'stage2', 'stage3', 'stage4']  # Stage slots available on a Rocket
+
+STAGE_REQUIRED = ['NAME', 'MIXTURE', 'PROPELLANT_MASS', 'DEAD_MASS', 'DIAMETER', 'DRAG_COEFFICIENT', 'fuel',
+                  'oxidizer']
+STAGE_OPTIONAL = ['DESCRIPTION', 'THRUST_SEA', 'THRUST_VAC', 'ISP_SEA', 'ISP_VAC', 'PAYLOAD_MASS', 'PAYLOAD_STAGE',
+                  'SRB_THRUST_SEA', 'SRB_THRUST_VAC', 'SRB_ISP_SEA', 'SRB_ISP_VAC', 'srb']
+PROPELLANT_REQUIRED = ['NAME']
+PROPELLANT_OPTIONAL = ['MASS_MAX', 'PRESSURE_RANGE', 'FLOW_RATE_MAX', 'mass', 'pressure']
+
+
+def _check_keys(name, values, required, optional):
+    """
+    Raises ValueError if a definition is missing a required key or has one that is not in the schema.
+    """
+    missing = [key for key in required if key not in values]
+    if missing:
+        raise ValueError(name + ' is missing ' + ', '.join(missing))
+    unknown = [key for key in values if key not in required and key not in optional]
+    if unknown:
+        raise ValueError(name + ' has unknown field(s) ' + ', '.join(unknown))
+
+
+def _number(name, value):
+    """
+    Raises ValueError unless value is a non-negative number.
+    :return: Returns value
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+        raise ValueError(name + ' must be a non-negative number, got ' + repr(value))
+    return value
+
+
+def _compile_propellant(name, values, mass_max, flow_rate_max):
+    """
+    This function fills in the derived values of one tank.
+    :param name: Name used in error messages
+    :param values: The tank's definition dictionary
+    :param mass_max: Tank capacity derived from the stage, used unless MASS_MAX is given
+    :param flow_rate_max: Flow rate derived from the stage, used unless FLOW_RATE_MAX is given
+    :return: Returns a PropellantDefinition
+    """
+    _check_keys(name, values, PROPELLANT_REQUIRED, PROPELLANT_OPTIONAL)
+    pressure_range = values.get('PRESSURE_RANGE', [0, 0])
+    if len(pressure_range) != 2:
+        raise ValueError(name + '.PRESSURE_RANGE must be [low, high]')
+    pressure_range = (_number(name + '.PRESSURE_RANGE', pressure_range[0]),
+                      _number(name + '.PRESSURE_RANGE', pressure_range[1]))
+
+    mass_max = _number(name + '.MASS_MAX', values.get('MASS_MAX', mass_max))
+    return PropellantDefinition(MASS_MAX=mass_max,
+                                PRESSURE_RANGE=pressure_range,
+                                FLOW_RATE_MAX=_number(name + '.FLOW_RATE_MAX',
+                                                      values.get('FLOW_RATE_MAX', flow_rate_max)),
+                                NAME=str(values['NAME']),
+                                mass=_number(name + '.mass', values.get('mass', mass_max)),
+                                pressure=_number(name + '.pressure',
+                                                 values.get('pressure', (pressure_range[0] + pressure_range[1]) / 2.0)),
+                                flow_rate=0)
+
+
+def _compile_stage(values, totals):
+    """
+    This function fills in the derived values of one stage.
+    :param values: The stage's definition dictionary
+    :param totals: Dictionary of already compiled stage total masses, for PAYLOAD_STAGE
+    :return: Returns a StageDefinition
+    """
+    name = values['NAME']
+    if 'PAYLOAD_STAGE' in values:
+        payload_mass = totals[values['PAYLOAD_STAGE']]
+    else:
+        payload_mass = values.get('PAYLOAD_MASS', 0)
+
+    numbers = dict((key, _number(name + '.' + key, values.get(key, 0)))
+                   for key in ['THRUST_SEA', 'THRUST_VAC', 'ISP_SEA', 'ISP_VAC', 'MIXTURE', 'PROPELLANT_MASS',
+                               'DEAD_MASS', 'DIAMETER', 'DRAG_COEFFICIENT', 'SRB_THRUST_SEA', 'SRB_THRUST_VAC',
+                               'SRB_ISP_SEA', 'SRB_ISP_VAC'])
+    numbers['PAYLOAD_MASS'] = _number(name + '.PAYLOAD_MASS', payload_mass)
+
+    # Tanks are sized from the mixture ratio and their flow rates from the engines' main operating point,
+    # mass flow = thrust / (ISP * g0). THRUST_* and ISP_* describe the liquid engines only, the SRBs have their own.
+    mixture = numbers['MIXTURE']
+    if numbers['THRUST_SEA'] > 0:
+        mass_flow = numbers['THRUST_SEA'] / (numbers['ISP_SEA'] * atmo.GRAVITY)
+    elif numbers['THRUST_VAC'] > 0:
+        mass_flow = numbers['THRUST_VAC'] / (numbers['ISP_VAC'] * atmo.GRAVITY)
+    else:
+        mass_flow = 0
+    fuel = _compile_propellant(name + '.fuel', values['fuel'], int(numbers['PROPELLANT_MASS'] / (mixture + 1)),
+                               mass_flow / (mixture + 1))
+    oxidizer = _compile_propellant(name + '.oxidizer', values['oxidizer'],
+                                   int(numbers['PROPELLANT_MASS'] * mixture / (mixture + 1)),
+                                   mass_flow * mixture / (mixture + 1))
+    srb = None
+    if 'srb' in values:
+        if numbers['SRB_THRUST_SEA'] <= 0 or numbers['SRB_ISP_SEA'] <= 0:
+            raise ValueError(name + ' has an srb but no SRB_THRUST_SEA and SRB_ISP_SEA')
+        srb = _compile_propellant(name + '.srb', values['srb'], 0,
+                                  numbers['SRB_THRUST_SEA'] / (numbers['SRB_ISP_SEA'] * atmo.GRAVITY))
+    elif numbers['SRB_THRUST_SEA'] > 0 or numbers['SRB_THRUST_VAC'] > 0:
+        raise ValueError(name + ' has SRB thrust but no srb')
+
+    return StageDefinition(NAME=name,
+                           DESCRIPTION=str(values.get('DESCRIPTION', '')),
+                           AREA=3.14 * numbers['DIAMETER'] ** 2,
+                           fuel=fuel,
+                           oxidizer=oxidizer,
+                           srb=srb,
+                           total_mass=numbers['DEAD_MASS'] + numbers['PROPELLANT_MASS'] + numbers['PAYLOAD_MASS'],
+                           **numbers)
+
+
+def compile_vehicle(values, file_hash=''):
+    """
+    This function validates a vehicle definition and computes every derived quantity once.
+    :param values: Dictionary read from a definition file
+    :param file_hash: Hash of the definition file, recorded in the result
+    :return: Returns a VehicleDefinition
+    """
+    _check_keys('vehicle', values, ['NAME', 'stages'], ['FLIGHT_PATH_ANGLE'])
+    stages = values['stages']
+    if not 0 < len(stages) <= len(STAGE_NAMES):
+        raise ValueError('a vehicle needs between 1 and ' + str(len(STAGE_NAMES)) + ' stages')
+
+    by_name = {}
+    for stage in stages:
+        _check_keys('stage ' + str(stage.get('NAME')), stage, STAGE_REQUIRED, STAGE_OPTIONAL)
+        if stage['NAME'] not in STAGE_NAMES:
+            raise ValueError('stage names must be one of ' + ', '.join(STAGE_NAMES) + ', got ' + str(stage['NAME']))
+        if stage['NAME'] in by_name:
+            raise ValueError('stage ' + stage['NAME'] + ' is defined twice')
+        by_name[stage['NAME']] = stage
+
+    # Compile stages after the stages they carry, since their payload is the carried stage's total mass
+    compiled = {}
+    totals = {}
+
+    def compile_named(stage_name, chain):
+        if stage_name in compiled:
+            return
+        if stage_name not in by_name:
+            raise ValueError('payload stage ' + stage_name + ' is not defined')
+        if stage_name in chain:
+            raise ValueError('payload stages form a loop: ' + ' -> '.join(chain + [stage_name]))
+        payload_stage = by_name[stage_name].get('PAYLOAD_STAGE')
+        if payload_stage is not None:
+            compile_named(payload_stage, chain + [stage_name])
+        compiled[stage_name] = _compile_stage(by_name[stage_name], totals)
+        totals[stage_name] = compiled[stage_name].total_mass
+
+    for stage in stages:
+        compile_named(stage['NAME'], [])
+
+    return VehicleDefinition(NAME=str(values['NAME']),
+                             FLIGHT_PATH_ANGLE=float(values.get('FLIGHT_PATH_ANGLE', 90)),
+                             stages=tuple(compiled[stage['NAME']] for stage in stages),
+                             HASH=file_hash)
+
+
+def parse(file_name, data):
+    """
+    This function reads a JSON or TOML definition.
+    :param file_name: Name of the definition file, the extension picks the format
+    :param data: Contents of the file as bytes
+    :return: Returns the definition dictionary
+    """
+    if file_name.endswith('.toml'):
+        if tomllib is None:
+            raise ValueError('reading TOML vehicle definitions needs Python 3.11 or newer')
+        return tomllib.loads(data.decode('utf-8'))
+    return json.loads(data.decode('utf-8'))
+
+
+def load(file_name=DEFAULT_VEHICLE, cache_directory=CACHE_DIRECTORY):
+    """
+    This function loads a compiled vehicle. The compiled form is cached as a pickle named after the hash of the
+    definition file, so later boots skip parsing and recomputing and editing the file invalidates the cache.
+    :param file_name: JSON or TOML vehicle definition
+    :param cache_directory: Directory of compiled vehicles, None disables the cache
+    :return: Returns a VehicleDefinition
+    """
+    with open(file_name, 'rb') as definition_file:
+        data = definition_file.read()
+    file_hash = hashlib.sha256(str(COMPILER_VERSION).encode('utf-8') + data).hexdigest()
+
+    cache_file = None
+    if cache_directory is not None:
+        cache_file = os.path.join(cache_directory, file_hash + '.pickle')
+        if os.path.exists(cache_file):
+            with open(cache_file, 'rb') as cached:
+                return pickle.load(cached)
+
+    definition = compile_vehicle(parse(file_name, data), file_hash)
+
+    if cache_file is not None:
+        # Write to a temporary file unique to this process then rename, so a crash never leaves a truncated cache
+        # file behind and pool workers compiling the same vehicle at once never rename each other's files
+        temp_name = None
+        try:
+            os.makedirs(cache_directory, exist_ok=True)
+            temp_handle, temp_name = tempfile.mkstemp(dir=cache_directory, suffix='.tmp')
+            with os.fdopen(temp_handle, 'wb') as cached:
+                pickle.dump(definition, cached, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_name, cache_file)
+        except OSError:
+            # The cache is only an optimization, a read-only or full disk still loads the vehicle
+            if temp_name is not None and os.path.exists(temp_name):
+                os.remove(temp_name)
+    return definition